@@ -1,5 +1,7 @@
 from __future__ import division, print_function
 import sys
+import sqlite3
+import time
 import datetime
 from os import path
 from functools import partial
@@ -10,10 +12,16 @@ from qtpy import QtCore, QtGui, QtWidgets
 import pyqtgraph as pg
 
 import csapi
-from gage_widgets import ChannelWidget, SlotHandler, TriggerDialog, RunWidget
+from gage_widgets import ChannelWidget, CountRateWidget, PlotScheduler, SlotHandler, TriggerDialog, RunWidget
 import gage_util
-from gage_util import GageMode, GageState, ChannelConfig, HeterodyneFilter, DecimateFilter, PeakIntegralFilter, get_script_path, log
+from gage_util import GageMode, GageState, PeakIntegralFilter, get_script_path, log
+from gage_channels import channel_config
 from gage_workers import GageCapture, GageSegWorker, GageTradWorker
+from gage_writer import GageWriter
+from gage_spool import GageSpool
+from gage_catalog import GageCatalog
+from gage_timing import PipelineTimer, RunStatistics
+import gage_trace as trace
 
 gage_util.print_level = 2
 pg.setConfigOptions(antialias=True, useWeave=True)
@@ -36,41 +44,74 @@ configuration
 
 dataRoot = 'Y:\\expdata-e6\\data\\'
 analysisRoot = 'Y:\\expdata-e6\\data\\'
+# Local directory to write to first. Files are moved to dataRoot in the background (None to write to dataRoot).
+spoolRoot = None  # 'D:\\gage-spool\\'
+spool_workers = 4
+# Add every saved file to the SQLite catalog in dataRoot (see gage_catalog.py, which also backfills old data)
+run_catalog = True
 
 try:
     csapi.Initialize()
 except Exception as err:
-    print('Failed to initialize GageScope API: ', err)
+    log('Failed to initialize GageScope API: {}'.format(err))
 
 sample_clk = 200e6
 ext_clk = 0 #200e6
-carrier_freq = 15e6
 
 trigger_config = (csapi.TriggerSource.EXT, csapi.Coupling.DC, csapi.Impedance.Z_1M, csapi.Gain.G_10Vpp)
 
-heterodyne = ChannelConfig(1, csapi.Coupling.DC, csapi.Impedance.Z_50, csapi.Gain.G_4Vpp, name='Heterodyne')
-heterodyne.filter = HeterodyneFilter(carrier_freq, bw=20e3, max_length=200e3)
-heterodyne.pen = (pg.mkPen('b', width=1), pg.mkPen('r', width=1))
-
-spcm = ChannelConfig(2, csapi.Coupling.DC, csapi.Impedance.Z_50, csapi.Gain.G_1Vpp, name='SPCM')
-# spcm.filter = DecimateFilter(10, max_length=200e3)
-spcm.filter = PeakIntegralFilter(0.045, 5, max_length=200e3)
-# 0.045 is the optimized peak height threshold
-# vco.pen = pg.mkPen('g', width=1)
-spcm.pen = (pg.mkPen('g', width=1), pg.mkPen('b', width=1), pg.mkPen('w', width=1), pg.mkPen('r', width=1))
-
-
-# vco = ChannelConfig(2, csapi.Coupling.DC, csapi.Impedance.Z_1M, csapi.Gain.G_2Vpp, resample=2e6, name='VCO')
-# vco.filter = DecimateFilter(10, max_length=200e3)
-# # vco.pen = pg.mkPen('g', width=1)
-# vco.pen = (pg.mkPen('g', width=1), pg.mkPen('r', width=1))
-
-# odt = ChannelConfig(3, csapi.Coupling.DC, csapi.Impedance.Z_1M, csapi.Gain.G_2Vpp, resample=2e6, name='ODT')
-# odt.filter = DecimateFilter(10, max_length=200e3)
-# # odt.pen = pg.mkPen('y', width=1)
-# odt.pen = (pg.mkPen('y', width=1), pg.mkPen('r', width=1))
-
-channel_config = ([spcm])
+# The channels to acquire and their display filters (channel_config) are configured in gage_channels.py, which
+# gage_viewer also imports
+
+# SEG mode: append iterations to a run-level HDF5 store instead of one file per iteration.
+# run_store_iterations splits the store into one file per N iterations (None for one file per run).
+run_store = False
+run_store_iterations = None
+# Open the run store in single-writer/multiple-reader mode, so analysis can read it while the run is going.
+# New iterations become visible to readers at most every flush_interval seconds.
+run_store_options = dict(swmr=False, flush_interval=1.0)
+
+# Write files from a dedicated writer thread, so a slow data drive does not block processing.
+# write_fsync_interval (s) forces written files to disk periodically (None to leave it to the OS).
+write_behind = True
+write_queue_size = 64
+write_fsync_interval = None
+
+# SEG mode: keep running per-trigger averages of the filtered traces (shown with 'Average' in the channel plots),
+# and save them to averages.h5 in the run directory when a run ends.
+running_averages = True
+save_averages = True
+
+# Strip chart of the photon counts of channels with a PeakIntegralFilter (span in s), and whether to append the
+# counts to the run store.
+count_rate_chart = True
+count_rate_span = 300.0
+store_photon_counts = True
+
+# Latency of the pipeline stages per capture, as p50/p99 in the status bar. latency_dump saves the histograms of a run
+# to its directory when it ends: 'csv' (percentiles per stage), 'h5' (full histograms) or None.
+latency_stats = True
+latency_dump = 'csv'
+
+# Per-run trigger accounting (seen, extra, missed by timeout or sequence skip, dropped) and the dead time from the
+# acquisition callback to re-arming, shown in the status bar and saved to run_stats.h5 in the run directory when a
+# run ends. Captures arriving while max_capture_backlog captures still wait for the worker are dropped (re-armed
+# without download) instead of queueing up without bound.
+run_stats = True
+max_capture_backlog = 64
+
+# Record a timeline of the acquisition callback, worker, writer and UI threads in a ring of trace_events events
+# (0 to disable), saved with File > Save trace in Chrome Trace Event format.
+trace_events = 0
+
+# Log file, rotated every log_max_bytes (None to log to the console only), and debug levels per module overriding
+# gage_util.print_level, e.g. {'gage_workers': 5} to follow trigger detection.
+log_file = path.join(get_script_path(), 'logs', 'gage_acquire.log')
+log_max_bytes = 10 * 1024 * 1024
+log_levels = {}
+
+# Maximum plot refresh rate. Captures arriving faster only update the data drawn in the next frame.
+plot_max_fps = 20
 
 
 class GageDummy(object):
@@ -117,12 +158,36 @@ class GageWindow(QtWidgets.QMainWindow):
 
         self._thread = None
         self._worker = None
+        self._writer = None
+
+        self.spool = None
+        if spoolRoot:
+            self.spool = GageSpool(spoolRoot, dataRoot, workers=spool_workers)
+            self.spool.recover()
+
+        self.catalog = None
+        if run_catalog:
+            try:
+                self.catalog = GageCatalog(dataRoot, spool_root=spoolRoot)
+            except sqlite3.Error as e:
+                log('Could not open the run catalog: {}'.format(e))
+
+        self.latency = PipelineTimer() if latency_stats else None
+        if trace_events > 0:
+            trace.enable(trace_events)
+        self.run_stats = RunStatistics() if run_stats else None
+        self._queued = 0  # Captures handed to the current worker
+        self._sequence = 0  # Acquisition callbacks, including dropped captures
+
+        self.status_timer = QtCore.QTimer()
+        self.status_timer.timeout.connect(self._update_status)
+        self.status_timer.start(1000)
 
         try:
             self.gage = csapi.System(reset=False)
         except Exception as e:
-            print('Error opening GageScope: ', e)
-            print('Continuing in debug mode')
+            log('Error opening GageScope: {}'.format(e))
+            log('Continuing in debug mode')
             self.gage = GageDummy()
 
         self.info = self.gage.GetInfo()
@@ -157,13 +222,23 @@ class GageWindow(QtWidgets.QMainWindow):
     def closeEvent(self, event):
         self._stop_acquisition()
 
+        if self._thread is not None:
+            self._thread.wait()
+        if self._writer is not None:
+            self._writer.stop()
+            self._writer = None
+        if self.spool is not None:
+            self.spool.stop()
+        if self.catalog is not None:
+            self.catalog.close()
+
         self.gage.Close()
         self.gage = None
         self.save_settings()
 
     def load_settings(self):
         if self._acquiring:
-            print('Cannot load settings file while acquiring')
+            log('Cannot load settings file while acquiring')
             return
 
         settings = ConfigParser()
@@ -236,10 +311,10 @@ class GageWindow(QtWidgets.QMainWindow):
 
     def _load_config(self, filename):
         if self._acquiring:
-            print('Cannot load config file while acquiring')
+            log('Cannot load config file while acquiring')
             return
 
-        print('Loading config file ''{}'''.format(filename))
+        log('Loading config file ''{}'''.format(filename))
 
         try:
             config = ConfigParser()
@@ -250,14 +325,14 @@ class GageWindow(QtWidgets.QMainWindow):
                 try:
                     self.mode = GageMode[mode]
                 except Exception as e:
-                    print('Invalid mode', e)
+                    log('Invalid mode {}'.format(e))
 
             if config.has_option('Global', 'length'):
                 length = config.get('Global', 'length')
                 try:
                     self.length_input.setValue(float(length))
                 except Exception as e:
-                    print('Invalid length', e)
+                    log('Invalid length {}'.format(e))
 
             if config.has_section('Triggers'):
                 self.triggers = []
@@ -276,7 +351,7 @@ class GageWindow(QtWidgets.QMainWindow):
             self.config_file = filename
             self._push_history(filename)
         except Exception as e:
-            print('Error reading config file: ', e)
+            log('Error reading config file: {}'.format(e))
 
     def menu_exit(self):
         self.close()
@@ -322,6 +397,20 @@ class GageWindow(QtWidgets.QMainWindow):
         self.config_file = filename
         self._save_config(self.config_file)
 
+    def menu_save_trace(self):
+        if not trace.enabled():
+            QtWidgets.QMessageBox.information(self, 'Save trace', 'Tracing is disabled, set trace_events to enable it.')
+            return
+
+        filename = QtWidgets.QFileDialog.getSaveFileName(self, "Save Trace", "", "Trace files (*.json);; All Files (*)")
+        if isinstance(filename, tuple):  # Qt4/5 compatibility
+            filename = filename[0]
+
+        if filename == '':
+            return
+
+        trace.dump(filename)
+
     def menu_trad(self):
         if self._acquiring:
             return
@@ -344,6 +433,9 @@ class GageWindow(QtWidgets.QMainWindow):
             ("&Save", 'Ctrl+S', 'Save the current configuration.', self.menu_save),
             ("Save &as...", 'Ctrl+Shift+S', 'Save the current configuration as...', self.menu_saveas),
             None,
+            ("Save &trace...", None, 'Save the recorded acquisition timeline (Chrome Trace Event format).',
+             self.menu_save_trace),
+            None,
             ("&Exit", 'Ctrl+Q', 'Stop acquisition and close the application.', self.menu_exit)
         ]
 
@@ -425,7 +517,14 @@ class GageWindow(QtWidgets.QMainWindow):
             self.state_changed.connect(cw.on_state_changed)
             self.triggers_changed.connect(cw.set_triggers)
 
-        self.run_widget = RunWidget(dataRoot, analysis_root=analysisRoot, mode=self.mode)
+        self.plot_scheduler = PlotScheduler(self.channel_widgets, max_fps=plot_max_fps, parent=self)
+
+        self.count_rate = None
+        if count_rate_chart and any(isinstance(channel.filter, PeakIntegralFilter) for channel in channel_config):
+            self.count_rate = CountRateWidget(span=count_rate_span)
+            layout.addWidget(self.count_rate)
+
+        self.run_widget = RunWidget(dataRoot, analysis_root=analysisRoot, mode=self.mode, spool_root=spoolRoot)
         self.run_widget.status.connect(self.run_status)
         # self.mode_changed.connect(self.run_widget.mode_changed)
         self.run_widget.setEnabled(False)
@@ -467,12 +566,18 @@ class GageWindow(QtWidgets.QMainWindow):
         if self.start_button.isChecked():
             self.start_button.setText('Starting...')
 
+            if write_behind:
+                self._writer = GageWriter(max_queue=write_queue_size, fsync_interval=write_fsync_interval)
+                self._writer.start()
+
             if self.mode == GageMode.TRAD:
                 self.sample_length = self.length_input.value()
                 for config in channel_config:
                     config.segments = []
 
-                self._worker = GageTradWorker(self.run_widget)
+                self._worker = GageTradWorker(self.run_widget, writer=self._writer, spool=self.spool,
+                                              catalog=self.catalog, stats=self.run_stats, latency=self.latency,
+                                              latency_dump=latency_dump)
 
             elif self.mode == GageMode.SEG:
                 self.sample_length = 0
@@ -484,12 +589,20 @@ class GageWindow(QtWidgets.QMainWindow):
                     if len(seg_ends) > 0:
                         self.sample_length = max(self.sample_length, max(seg_ends))
 
-                self._worker = GageSegWorker(self.run_widget, self.triggers)
+                self._worker = GageSegWorker(self.run_widget, self.triggers, run_store=run_store,
+                                             store_iterations=run_store_iterations,
+                                             store_options=run_store_options, writer=self._writer,
+                                             spool=self.spool, catalog=self.catalog, averages=running_averages,
+                                             save_averages=save_averages, store_counts=store_photon_counts,
+                                             stats=self.run_stats, latency=self.latency,
+                                             latency_dump=latency_dump)
 
             self.sample_depth = int(sample_clk * self.sample_length / 1e3)
 
             for cid, cw in self.channel_widgets.items():
-                cw._pw.setXRange(0, self.sample_length * 1e-3)
+                if cw.config.filter.time_domain:
+                    cw._pw.setXRange(0, self.sample_length * 1e-3)
+                cw.clear_persistence()
 
             log('Starting acquisition for {:.1f} ms ({:d} samples)'.format(self.sample_length, self.sample_depth))
             self._gage_configure()
@@ -498,12 +611,19 @@ class GageWindow(QtWidgets.QMainWindow):
             self._worker.moveToThread(self._thread)
             self.capture_acquired.connect(self._worker.process_capture)
             self._worker.plot_capture.connect(self._plot_capture)
+            self._worker.plot_average.connect(self._plot_average)
+            if self.count_rate is not None:
+                self._worker.photon_counts.connect(self.count_rate.add_counts)
+            self.run_widget.status.connect(self._worker.run_status)
 
             self._thread.started.connect(self._worker.started)
+            self._thread.finished.connect(self._worker.stopped, QtCore.Qt.DirectConnection)
             self._thread.finished.connect(self._thread_finished)
 
             self._thread.start()
 
+            self._queued = 0
+            self._sequence = 0
             self._acquiring = True
             self.gage.Start()  # Arm acquisition
             self.state = GageState.ACQUIRE
@@ -527,11 +647,33 @@ class GageWindow(QtWidgets.QMainWindow):
         # Manually disconnect this signal, otherwise it somehow remains connected within Qt, and the GageCapture objects
         # queue up in the void somewhere on the defunct worker object/thread, causing a memory leak
         self.capture_acquired.disconnect(self._worker.process_capture)
+        self.run_widget.status.disconnect(self._worker.run_status)
         self._worker.deleteLater()
         self._worker = None
         self._thread.deleteLater()
         self._thread = None
 
+        if self._writer is not None:
+            # Wait for queued files to be written
+            self._writer.stop()
+            self._writer = None
+
+    def _update_status(self):
+        frames, coalesced = self.plot_scheduler.stats()
+        status = ['Plot: {:d} traces/s ({:d} coalesced)'.format(frames, coalesced)]
+
+        if self._writer is not None:
+            depth, rate, disk_rate = self._writer.stats()
+            status.append('Write queue: {:d} | {:.1f} MB/s ({:.1f} MB/s disk)'.format(depth, rate, disk_rate))
+        if self.spool is not None:
+            status.append('Spool backlog: {:d} ({:d} failed)'.format(self.spool.backlog, self.spool.failed))
+        if self.latency is not None and self.latency.summary():
+            status.append('Latency p50/p99 (ms): ' + self.latency.status())
+        if self.run_stats is not None:
+            status.append(self.run_stats.status())
+
+        self.statusBar().showMessage(' | '.join(status))
+
     def _gage_configure(self):
         self.gage.SetAcquisition(
             sample_rate=int(sample_clk),
@@ -606,36 +748,52 @@ class GageWindow(QtWidgets.QMainWindow):
             log('Run ''{}'' stopped'.format(runname))
             self.start_button.setEnabled(True)
 
+    @trace.traced('on_acquired')
     def on_acquired(self,cbInfo):
+        trigger_ns = time.perf_counter_ns()
         timestamp = datetime.datetime.now()
-        print('on_acquired')
         if not self._acquiring:
             return
 
         log('Acquired', 3)
+        self._sequence += 1
+
+        worker = self._worker
+        if worker is not None and self._queued - worker.processed >= max_capture_backlog:
+            # The worker is falling behind, re-arm without downloading
+            with trace.span('Start'):
+                self.gage.Start()
+            if self.run_stats is not None:
+                self.run_stats.count('queue_drops')
+                self.run_stats.record_dead_time(time.perf_counter_ns() - trigger_ns)
+            log('Worker queue full ({:d} captures), capture dropped'.format(max_capture_backlog), 1, rate_limit=5.0)
+            return
 
-        capture = GageCapture(channel_config, timestamp)
+        capture = GageCapture(channel_config, timestamp, timer=self.latency)
+        capture.sequence = self._sequence
+        capture.stamp('trigger', trigger_ns)
         capture.download(self.gage)
+        capture.stamp('download')
 
         log('Downloaded', 4)
 
-        self.gage.Start()  # Re-arm acquisition
+        with trace.span('Start'):
+            self.gage.Start()  # Re-arm acquisition
+        capture.stamp('rearm')
+        if self.run_stats is not None:
+            self.run_stats.record_dead_time(capture.stamps['rearm'] - trigger_ns)
 
+        self._queued += 1
         self.capture_acquired.emit(capture)
 
-    def _plot_capture(self, plot_data, line):
-        # This slot is triggered by the plot_capture signal in the Worker, and plots each capture in the UI thread
-        # after processing is finished
-        log('Start plotting', 6)
+    @trace.traced('_plot_capture')
+    def _plot_capture(self, plot_data, line, capture):
+        # This slot is triggered by the plot_capture signal in the Worker, after processing is finished. The data is
+        # handed to the plot scheduler, which draws the latest capture of each line at its next frame.
+        self.plot_scheduler.submit(plot_data, line, capture=capture)
 
-        for cid, widget in self.channel_widgets.items():
-            if cid not in plot_data:
-                continue
-
-            filt_time, filt_data = plot_data[cid]
-            widget.plot(filt_time, filt_data, line=line)
-
-        log('Finished plotting', 6)
+    def _plot_average(self, average_data, line):
+        self.plot_scheduler.submit(average_data, line, average=True)
 
 
 # Start Qt event loop unless running in interactive mode.
@@ -647,6 +805,9 @@ def main():
     except Exception:
         pass
 
+    gage_util.log_levels.update(log_levels)
+    gage_util.setup_logging(log_file, max_bytes=log_max_bytes)
+
     app = QtWidgets.QApplication(sys.argv)
     app.setWindowIcon(QtGui.QIcon('favicon.ico'))
     ex = GageWindow()
@@ -0,0 +1,264 @@
+from __future__ import division, print_function
+import argparse
+import fnmatch
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from os import path
+
+import numpy as np
+import h5py
+
+import sigfile
+from gage_util import log
+
+# SQLite catalog of everything saved below a data root, one row per saved iteration (or .sig file) in 'entries'
+# and one row per channel of it in 'channels'. Paths are relative to the data root. Example query, all SPCM
+# iterations at 1 Vpp of the last week:
+#
+#   SELECT e.path, e.iteration FROM entries e JOIN channels c USING (path, iteration)
+#   WHERE c.name = 'SPCM' AND c.input_range = 1000 AND e.timestamp > strftime('%s', 'now', '-7 days')
+
+CATALOG_NAME = 'gage_catalog.sqlite'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS entries (
+    path TEXT NOT NULL,
+    iteration INTEGER NOT NULL,
+    kind TEXT,
+    date TEXT,
+    run TEXT,
+    prefixes TEXT,
+    timestamp REAL,
+    timestamps TEXT,
+    missed INTEGER,
+    missed_flags TEXT,
+    mtime REAL,
+    PRIMARY KEY (path, iteration)
+);
+CREATE TABLE IF NOT EXISTS channels (
+    path TEXT NOT NULL,
+    iteration INTEGER NOT NULL,
+    channel INTEGER NOT NULL,
+    name TEXT,
+    input_range REAL,
+    sample_rate REAL,
+    coupling INTEGER,
+    impedance INTEGER,
+    PRIMARY KEY (path, iteration, channel)
+);
+CREATE INDEX IF NOT EXISTS entries_date ON entries (date);
+CREATE INDEX IF NOT EXISTS entries_run ON entries (run);
+CREATE INDEX IF NOT EXISTS entries_timestamp ON entries (timestamp);
+CREATE INDEX IF NOT EXISTS channels_name ON channels (name, input_range);
+'''
+
+H5_PATH = re.compile(r'^(?P<date>.+)/data/(?P<run>[^/]+)/gagescope/[^/]+\.h5$')
+SIG_PATH = re.compile(r'^(?P<date>.+)/(?P<run>[^/]+)_CH(?P<channel>\d+)/Folder\.\d+/AS_CH\d+-(?P<number>\d+)\.sig$')
+
+
+def parse_path(relpath):
+    # Returns (date, run) from a path laid out by RunWidget.getTarget/getTargetH5
+    relpath = relpath.replace('\\', '/')
+    match = H5_PATH.match(relpath) or SIG_PATH.match(relpath)
+    if match is None:
+        return None, None
+    return match.group('date').replace('/', '-'), match.group('run')
+
+
+def _iteration_number(filename):
+    match = re.search(r'(\d+)\.(h5|sig)$', filename)
+    return int(match.group(1)) if match else 0
+
+
+def _posix(timestamp):
+    try:
+        return time.mktime(time.strptime(timestamp.split('.')[0], '%Y-%m-%dT%H:%M:%S'))
+    except (ValueError, AttributeError):
+        return None
+
+
+def _entry(relpath, iteration, kind, prefixes, timestamps, missed_flags, channels, mtime):
+    # timestamps: list of POSIX times (None if missed), channels: list of (cid, name, input_range, rate, coupling,
+    # impedance)
+    date, run = parse_path(relpath)
+    present = [t for t in timestamps if t is not None]
+    entry = (relpath, iteration, kind, date, run, ','.join(prefixes), min(present) if present else None,
+             json.dumps(timestamps), int(sum(missed_flags)), json.dumps([bool(m) for m in missed_flags]), mtime)
+    return entry, [(relpath, iteration) + tuple(channel) for channel in channels]
+
+
+def entries_from_iteration(relpath, iteration, number, kind='h5', mtime=None):
+    # Catalog rows of a GageIteration, as saved with save_h5 or appended to a run store
+    prefixes = [prefix for prefix, timeout in iteration.triggers]
+    timestamps = [iteration.captures[idx].timestamp.timestamp() if idx in iteration.captures else None
+                  for idx in range(len(prefixes))]
+    missed = [idx not in iteration.captures for idx in range(len(prefixes))]
+
+    capture = iteration.first_capture()
+    channels = [(cid, config.name, capture.channels[cid].input_range, capture.channel_rate[cid],
+                 capture.channels[cid].term, capture.channels[cid].impedance)
+                for cid, config in capture.channel_config.items()]
+
+    return [_entry(relpath, number, kind, prefixes, timestamps, missed, channels, mtime)]
+
+
+def entries_from_capture(relpath, capture, cid, number, mtime=None):
+    # Catalog rows of a .sig file saved with save_channel_sig
+    channel = capture.channels[cid]
+    channels = [(cid, capture.channel_config[cid].name, channel.input_range, capture.channel_rate[cid], channel.term,
+                 channel.impedance)]
+    return [_entry(relpath, number, 'sig', [''], [capture.timestamp.timestamp()], [False], channels, mtime)]
+
+
+def entries_from_sig(filepath, relpath):
+    header = sigfile.read_header(filepath)
+    match = SIG_PATH.match(relpath.replace('\\', '/'))
+    cid = int(match.group('channel')) if match else 0
+    channels = [(cid, None, sigfile.GAIN_RANGE[header['captured_gain']] * 1000, sigfile.header_sample_rate(header),
+                 int(header['captured_coupling']), 50 if header['imped_a'] == 0x10 else 1000000)]
+    timestamp = sigfile.header_timestamp(header)
+    timestamp = time.mktime(timestamp.timetuple())
+    return [_entry(relpath, _iteration_number(filepath), 'sig', [''], [timestamp], [False], channels,
+                   path.getmtime(filepath))]
+
+
+def entries_from_h5(filepath, relpath):
+    mtime = path.getmtime(filepath)
+    entries = []
+
+    with h5py.File(filepath, 'r') as hf:
+        channels = []
+        for group_name, hg in hf.items():
+            if not isinstance(hg, h5py.Group) or not group_name.startswith('ch'):
+                continue
+            rates = [1.0 / dset.attrs['dx'] for dset in hg.values() if 'dx' in dset.attrs]
+            channels.append((int(group_name[2:]), hg.attrs.get('name'), hg.attrs.get('input_range'),
+                             rates[0] if rates else None, hg.attrs.get('input_coupling'),
+                             hg.attrs.get('input_impedance')))
+        channels = [tuple(value.item() if isinstance(value, np.generic) else value for value in channel)
+                    for channel in channels]
+
+        if 'index' in hf:
+            # Run store, one row per iteration
+            prefixes = list(hf.attrs['prefixes'])
+            for row in hf['index'][:]:
+                timestamps = [None if np.isnan(t) else float(t) for t in row['timestamp']]
+                entries.append(_entry(relpath, int(row['iteration']), 'store', prefixes, timestamps, row['missed'],
+                                      channels, mtime))
+        else:
+            names = sorted(key[:-len('timestamp')].rstrip('_') for key in hf.attrs if key.endswith('timestamp'))
+            timestamps = [_posix(hf.attrs[('{}_timestamp'.format(name) if name else 'timestamp')]) for name in names]
+            entries.append(_entry(relpath, _iteration_number(filepath), 'h5', names, timestamps,
+                                  [False] * len(names), channels, mtime))
+
+    return entries
+
+
+class GageCatalog(object):
+    """
+    Catalog database of a data root. add() can be called from any thread; rows are committed in batches, at most
+    commit_interval seconds after they were added.
+    """
+
+    def __init__(self, data_root, spool_root=None, filename=None, commit_interval=5.0):
+        self.data_root = data_root
+        self.spool_root = spool_root
+        self.filename = filename if filename is not None else path.join(data_root, CATALOG_NAME)
+        self.commit_interval = commit_interval
+
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.filename, check_same_thread=False)
+        self._db.executescript(SCHEMA)
+        self._pending = 0
+        self._last_commit = time.perf_counter()
+
+    def relpath(self, filepath):
+        if self.spool_root and path.abspath(filepath).startswith(path.abspath(self.spool_root)):
+            return path.relpath(filepath, self.spool_root)
+        return path.relpath(filepath, self.data_root)
+
+    def add(self, entries):
+        with self._lock:
+            for entry, channels in entries:
+                self._db.execute('INSERT OR REPLACE INTO entries VALUES (?,?,?,?,?,?,?,?,?,?,?)', entry)
+                self._db.executemany('INSERT OR REPLACE INTO channels VALUES (?,?,?,?,?,?,?,?)', channels)
+                self._pending += 1
+
+            if time.perf_counter() - self._last_commit > self.commit_interval:
+                self._commit()
+
+    def commit(self):
+        with self._lock:
+            self._commit()
+
+    def _commit(self):
+        if self._pending > 0:
+            self._db.commit()
+            self._pending = 0
+        self._last_commit = time.perf_counter()
+
+    def close(self):
+        with self._lock:
+            self._commit()
+            self._db.close()
+
+    def query(self, sql, parameters=()):
+        with self._lock:
+            return self._db.execute(sql, parameters).fetchall()
+
+    def indexed_mtimes(self):
+        return dict(self.query('SELECT path, MAX(mtime) FROM entries GROUP BY path'))
+
+
+def _read_entries(filepath, relpath):
+    try:
+        if filepath.endswith('.sig'):
+            return entries_from_sig(filepath, relpath)
+        else:
+            return entries_from_h5(filepath, relpath)
+    except (IOError, OSError, KeyError, ValueError) as e:
+        log('Could not index {}: {}'.format(filepath, e), 1)
+        return []
+
+
+def index_archive(data_root, catalog=None, workers=16, patterns=('iteration_*.h5', 'iterations*.h5', 'AS_CH*.sig')):
+    # Backfills the catalog with all files below data_root that are new or changed since they were indexed
+    own_catalog = catalog is None
+    if own_catalog:
+        catalog = GageCatalog(data_root)
+
+    known = catalog.indexed_mtimes()
+    files = []
+    for dirpath, dirnames, filenames in os.walk(data_root):
+        for filename in filenames:
+            if any(fnmatch.fnmatch(filename, pattern) for pattern in patterns):
+                filepath = path.join(dirpath, filename)
+                relpath = path.relpath(filepath, data_root)
+                if known.get(relpath) != path.getmtime(filepath):
+                    files.append((filepath, relpath))
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for entries in executor.map(lambda args: _read_entries(*args), files):
+            catalog.add(entries)
+
+    catalog.commit()
+    if own_catalog:
+        catalog.close()
+
+    return len(files)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Index the files below a data root into its catalog database.')
+    parser.add_argument('data_root')
+    parser.add_argument('--workers', type=int, default=16)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    count = index_archive(args.data_root, workers=args.workers)
+    print('Indexed {:d} files in {:.1f} s'.format(count, time.perf_counter() - start))
@@ -0,0 +1,38 @@
+from __future__ import division, print_function
+import pyqtgraph as pg
+
+import csapi
+from gage_util import ChannelConfig, HeterodyneFilter, DecimateFilter, PeakIntegralFilter, SpectrumFilter
+
+# Channel configuration of the acquisition, with the display filters of the channels. Kept apart from
+# gage_acquire_h5 so gage_viewer can import it without initializing the digitizer. The imported filters are also
+# those of the commented examples.
+
+carrier_freq = 15e6
+
+heterodyne = ChannelConfig(1, csapi.Coupling.DC, csapi.Impedance.Z_50, csapi.Gain.G_4Vpp, name='Heterodyne')
+heterodyne.filter = HeterodyneFilter(carrier_freq, bw=20e3, max_length=200e3)
+heterodyne.pen = (pg.mkPen('b', width=1), pg.mkPen('r', width=1))
+# heterodyne.filter = SpectrumFilter(nperseg=8192, averaging='exponential', alpha=0.1)  # Spectrum around the carrier
+
+spcm = ChannelConfig(2, csapi.Coupling.DC, csapi.Impedance.Z_50, csapi.Gain.G_1Vpp, name='SPCM')
+# spcm.filter = DecimateFilter(10, max_length=200e3)
+spcm.filter = PeakIntegralFilter(0.045, 5, max_length=200e3)
+# 0.045 is the optimized peak height threshold
+# spcm.persistence = dict(time_bins=1000, amplitude_bins=256, decay=0.99)  # Show the distribution over many shots
+# spcm.shuffle, spcm.compression, spcm.compression_opts = True, 'gzip', 1  # Compress saved segments
+# vco.pen = pg.mkPen('g', width=1)
+spcm.pen = (pg.mkPen('g', width=1), pg.mkPen('b', width=1), pg.mkPen('w', width=1), pg.mkPen('r', width=1))
+
+
+# vco = ChannelConfig(2, csapi.Coupling.DC, csapi.Impedance.Z_1M, csapi.Gain.G_2Vpp, resample=2e6, name='VCO')
+# vco.filter = DecimateFilter(10, max_length=200e3)
+# # vco.pen = pg.mkPen('g', width=1)
+# vco.pen = (pg.mkPen('g', width=1), pg.mkPen('r', width=1))
+
+# odt = ChannelConfig(3, csapi.Coupling.DC, csapi.Impedance.Z_1M, csapi.Gain.G_2Vpp, resample=2e6, name='ODT')
+# odt.filter = DecimateFilter(10, max_length=200e3)
+# # odt.pen = pg.mkPen('y', width=1)
+# odt.pen = (pg.mkPen('y', width=1), pg.mkPen('r', width=1))
+
+channel_config = ([spcm])
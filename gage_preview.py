@@ -0,0 +1,100 @@
+from __future__ import division, print_function
+import os
+from os import path
+
+import numpy as np
+import h5py
+
+import sigfile
+from gage_util import minmax_pyramid
+
+# Min/max preview pyramids of saved segments. In HDF5 iteration files the levels of segment ch{cid}/{name} are
+# kept in preview/ch{cid}/{name}/x{factor} as (bins, 2) arrays of raw min and max, with the x0 and dx of the raw
+# data as attributes of the segment group. .sig files get a sidecar <file>.sig.preview.h5 with the same layout under
+# preview/data. A viewer reads the coarsest level that still has a bin per screen pixel, and only its visible range.
+
+PREVIEW_GROUP = 'preview'
+SIDECAR_SUFFIX = '.preview.h5'
+
+
+def write_pyramid(group, name, data, x0, dx, factors):
+    hg = group.require_group(name)
+    hg.attrs['x0'] = x0
+    hg.attrs['dx'] = dx
+    hg.attrs['length'] = len(data)
+
+    for factor, level in minmax_pyramid(data, factors):
+        dset = hg.create_dataset('x{:d}'.format(factor), data=level)
+        dset.attrs['factor'] = factor
+
+
+def sidecar_name(filepath):
+    return filepath + SIDECAR_SUFFIX
+
+
+def write_sidecar(filepath, data, x0, dx, factors):
+    # Preview of a .sig file, written to a .part file first so readers never see a partial sidecar
+    filename = sidecar_name(filepath)
+    partial_file = filename + '.part'
+    with h5py.File(partial_file, 'w') as hf:
+        write_pyramid(hf.require_group(PREVIEW_GROUP), 'data', data, x0, dx, factors)
+    os.replace(partial_file, filename)
+
+
+def select_level(factors, samples, pixels):
+    # Coarsest factor that still gives at least one bin per pixel over samples raw samples (1 for the raw data)
+    level = 1
+    for factor in sorted(factors):
+        if samples / factor >= pixels:
+            level = factor
+    return level
+
+
+def _read_level(hg, start, stop, pixels):
+    # Returns (t, min, max, factor) of samples [start, stop) of the segment group hg, from the selected level, or
+    # None if the raw data is needed
+    x0, dx, length = hg.attrs['x0'], hg.attrs['dx'], int(hg.attrs['length'])
+    start = max(0, start)
+    stop = length if stop is None else min(stop, length)
+
+    factor = select_level([hg[name].attrs['factor'] for name in hg], stop - start, pixels)
+    if factor == 1:
+        return None
+
+    first, last = start // factor, -(-stop // factor)
+    level = hg['x{:d}'.format(factor)][first:last]
+    t = x0 + dx * factor * (first + np.arange(len(level)))
+    return t, level[:, 0], level[:, 1], factor
+
+
+def read_preview(filepath, key='data', start=0, stop=None, pixels=2000):
+    """
+    Reads raw samples [start, stop) of segment key ('ch{cid}/{name}' in an iteration file, 'data' for a .sig file)
+    at the resolution needed for pixels screen pixels. Returns (t, min, max, factor) in raw ADC counts, with
+    min == max for factor 1 (no coarser level available, or a range short enough to read in full).
+    """
+    if filepath.endswith('.sig'):
+        sidecar = sidecar_name(filepath)
+        if path.exists(sidecar):
+            with h5py.File(sidecar, 'r') as hf:
+                preview = _read_level(hf[PREVIEW_GROUP]['data'], start, stop, pixels)
+            if preview is not None:
+                return preview
+
+        with sigfile.open_sig(filepath) as sig:
+            stop = len(sig) if stop is None else min(stop, len(sig))
+            data = np.array(sig.data[start:stop])
+            t = sig.time(start, stop)
+        return t, data, data, 1
+
+    with h5py.File(filepath, 'r') as hf:
+        preview_key = '{}/{}'.format(PREVIEW_GROUP, key)
+        if preview_key in hf:
+            preview = _read_level(hf[preview_key], start, stop, pixels)
+            if preview is not None:
+                return preview
+
+        dset = hf[key]
+        data = dset[start:stop]
+        t = dset.attrs.get('x0', 0.0) + dset.attrs.get('dx', 1.0) * (start + np.arange(len(data)))
+        return t, data, data, 1
@@ -0,0 +1,184 @@
+from __future__ import division, print_function
+import fnmatch
+import os
+import re
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from os import path
+
+import numpy as np
+import h5py
+
+from gage_preview import PREVIEW_GROUP
+
+# Loads SEG mode runs saved by GageIteration.save_h5 (iteration_XXXXX.h5 files) into preallocated numpy arrays.
+# File metadata is memoized per (file, size, mtime), and samples of contiguous datasets are read at their file
+# offsets from a thread pool, outside the h5py lock, so loading a run is limited by the disks rather than by Python.
+
+DatasetInfo = namedtuple('DatasetInfo', ('shape', 'dtype', 'x0', 'dx', 'offset'))
+FileInfo = namedtuple('FileInfo', ('datasets', 'channels', 'timestamps'))
+
+
+class Segment(object):
+    """
+    One segment across the loaded iterations. data is (iterations, samples), raw int16 or volts as float32, present
+    marks the iterations that contain the segment (missing ones are zero).
+    """
+
+    def __init__(self, data, present, x0, dx):
+        self.data = data
+        self.present = present
+        self.x0 = x0
+        self.dx = dx
+
+    @property
+    def t(self):
+        return self.x0 + self.dx * np.arange(self.data.shape[1])
+
+
+class RunData(object):
+
+    def __init__(self, files, iterations):
+        self.files = files
+        self.iterations = iterations
+        self.segments = {}  # 'ch{cid}/{prefix}_{segment}' -> Segment
+        self.timestamps = {}  # '{prefix}_timestamp' -> list of str
+
+    def __getitem__(self, key):
+        return self.segments[key]
+
+    def keys(self):
+        return self.segments.keys()
+
+
+def _iteration_number(filename):
+    match = re.search(r'(\d+)\.h5$', filename)
+    return int(match.group(1)) if match else -1
+
+
+def list_iterations(run_path):
+    # Returns {iteration number: file path} for the iteration files of a run
+    return {_iteration_number(name): path.join(run_path, name) for name in os.listdir(run_path)
+            if fnmatch.fnmatch(name, 'iteration_*.h5')}
+
+
+@lru_cache(maxsize=16384)
+def _file_info(filepath, size, mtime):
+    datasets = {}
+    channels = {}
+    with h5py.File(filepath, 'r') as hf:
+        timestamps = {key: value for key, value in hf.attrs.items() if key.endswith('timestamp')}
+
+        for group_name, hg in hf.items():
+            if not isinstance(hg, h5py.Group) or group_name == PREVIEW_GROUP:
+                continue
+            channels[group_name] = dict(hg.attrs)
+
+            for name, dset in hg.items():
+                offset = dset.id.get_offset() if dset.chunks is None else None
+                datasets['{}/{}'.format(group_name, name)] = DatasetInfo(dset.shape, dset.dtype,
+                                                                         dset.attrs.get('x0', 0.0),
+                                                                         dset.attrs.get('dx', 1.0), offset)
+
+    return FileInfo(datasets, channels, timestamps)
+
+
+def file_info(filepath):
+    # Memoized metadata of an iteration file. Rewritten files are detected by size and mtime.
+    stat = os.stat(filepath)
+    return _file_info(filepath, stat.st_size, stat.st_mtime)
+
+
+def clear_cache():
+    _file_info.cache_clear()
+
+
+def _scale(raw, channel, out):
+    # Same scaling as GageCapture.prepare_plot
+    scale = channel['input_range'] / 2000.0 / channel['sample_res']
+    np.subtract(channel['sample_offset'], raw, out=out, casting='unsafe')
+    out *= scale
+    out += channel.get('dc_offset', 0)
+
+
+def _read_file(filepath, info, row, keys, result, volts):
+    raw_buffers = {}
+
+    with open(filepath, 'rb') as f:
+        for key in keys:
+            ds = info.datasets.get(key)
+            if ds is None or ds.offset is None:
+                continue
+
+            segment = result.segments[key]
+            length = min(ds.shape[0], segment.data.shape[1])
+            raw = np.empty(ds.shape[0], dtype=ds.dtype)
+            f.seek(ds.offset)
+            f.readinto(memoryview(raw).cast('B'))
+            raw_buffers[key] = raw[:length]
+
+    # Chunked or compressed datasets go through h5py
+    missing = [key for key in keys if key in info.datasets and key not in raw_buffers]
+    if missing:
+        with h5py.File(filepath, 'r') as hf:
+            for key in missing:
+                length = min(info.datasets[key].shape[0], result.segments[key].data.shape[1])
+                raw_buffers[key] = hf[key][:length]
+
+    for key, raw in raw_buffers.items():
+        segment = result.segments[key]
+        if volts:
+            _scale(raw, info.channels[key.split('/')[0]], segment.data[row, :len(raw)])
+        else:
+            segment.data[row, :len(raw)] = raw
+        segment.present[row] = True
+
+
+def load_run(run_path, iterations=None, channels=None, segments=None, volts=False, workers=8):
+    """
+    Loads the iterations (numbers, default all) of a run directory. channels selects channel ids, segments the
+    dataset names ('{prefix}_{segment}'), both default all. With volts=True the data is scaled to float32 volts.
+    """
+    available = list_iterations(run_path)
+    if iterations is None:
+        iterations = sorted(available)
+    iterations = [number for number in iterations if number in available]
+    files = [available[number] for number in iterations]
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        infos = list(executor.map(file_info, files))
+
+        result = RunData(files, np.array(iterations))
+
+        # Size each segment to the longest occurrence in the selected files
+        shapes = {}
+        for info in infos:
+            for key, ds in info.datasets.items():
+                group_name, name = key.split('/', 1)
+                if channels is not None and group_name not in ['ch{}'.format(cid) for cid in channels]:
+                    continue
+                if segments is not None and name not in segments:
+                    continue
+                length, x0, dx = shapes.get(key, (0, ds.x0, ds.dx))
+                shapes[key] = (max(length, ds.shape[0]), x0, dx)
+
+        dtype = np.float32 if volts else np.int16
+        for key, (length, x0, dx) in shapes.items():
+            result.segments[key] = Segment(np.zeros((len(files), length), dtype=dtype),
+                                           np.zeros(len(files), dtype=bool), x0, dx)
+
+        for info in infos:
+            for name in info.timestamps:
+                result.timestamps.setdefault(name, [''] * len(files))
+        for row, info in enumerate(infos):
+            for name, value in info.timestamps.items():
+                result.timestamps[name][row] = value
+
+        keys = list(shapes)
+        futures = [executor.submit(_read_file, filepath, info, row, keys, result, volts)
+                   for row, (filepath, info) in enumerate(zip(files, infos))]
+        for future in futures:
+            future.result()
+
+    return result
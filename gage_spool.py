@@ -0,0 +1,158 @@
+from __future__ import division, print_function
+import hashlib
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from os import path
+
+from gage_util import log
+
+
+class GageSpool(object):
+    """
+    Local spool for acquisition output. Files are written below spool_root with the same relative layout as below
+    data_root, and a pool of mover threads copies them to data_root, verifies size and checksum, and removes the
+    spooled copy. Failed copies are retried with exponential backoff; files that still fail stay in the spool and are
+    picked up again by recover().
+    """
+
+    def __init__(self, spool_root, data_root, workers=4, retries=5, backoff=1.0, verify=True):
+        self.spool_root = spool_root
+        self.data_root = data_root
+        self.retries = retries
+        self.backoff = backoff
+        self.verify = verify
+
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._lock = threading.Lock()
+        self._copied = threading.Condition(self._lock)
+        self._pending = {}  # filepath -> token of the move job, a reclaimed and resubmitted file gets a new one
+        self._copying = set()
+        self._stopping = False
+
+        self.moved = 0
+        self.failed = 0
+        self.bytes_moved = 0
+
+    @property
+    def backlog(self):
+        with self._lock:
+            return len(self._pending)
+
+    def is_pending(self, filepath):
+        with self._lock:
+            return filepath in self._pending
+
+    def target(self, filepath):
+        return path.join(self.data_root, path.relpath(filepath, self.spool_root))
+
+    def submit(self, filepath):
+        with self._lock:
+            if filepath in self._pending or self._stopping:
+                return
+            token = object()
+            self._pending[filepath] = token
+
+        self._executor.submit(self._move, filepath, token)
+
+    def reclaim(self, filepath, timeout=None):
+        # Takes a file back from the spool before it is moved, e.g. to append to it again. A queued or retrying move
+        # is dropped without waiting, only a copy in progress is waited for. Returns False if that copy did not end
+        # within timeout. If it succeeded, the file is in the data root by now.
+        with self._copied:
+            if not self._copied.wait_for(lambda: filepath not in self._copying, timeout):
+                return False
+            self._pending.pop(filepath, None)
+            return True
+
+    def recover(self, exclude=('.part',)):
+        # Queue files left in the spool by an earlier session
+        count = 0
+        for dirpath, dirnames, filenames in os.walk(self.spool_root):
+            for filename in filenames:
+                if filename.endswith(exclude):
+                    continue
+                self.submit(path.join(dirpath, filename))
+                count += 1
+
+        if count > 0:
+            log('Recovered {:d} spooled files'.format(count))
+
+    def stop(self, wait=True):
+        # Files not yet moved stay in the spool, and are picked up by recover() next time
+        self._stopping = True
+        self._executor.shutdown(wait=wait)
+
+    def _move(self, filepath, token):
+        try:
+            for attempt in range(self.retries + 1):
+                with self._lock:
+                    if self._stopping or self._pending.get(filepath) is not token:
+                        return  # Stopping, or reclaimed
+                    self._copying.add(filepath)
+
+                try:
+                    try:
+                        self._copy(filepath, self.target(filepath))
+                        os.remove(filepath)
+                    finally:
+                        with self._copied:
+                            self._copying.discard(filepath)
+                            self._copied.notify_all()
+                    with self._lock:
+                        self.moved += 1
+                    log('Moved {}'.format(filepath), 4)
+                    return
+                except (IOError, OSError) as e:
+                    delay = self.backoff * 2 ** attempt
+                    log('Moving {} failed ({}), retry in {:.1f} s'.format(filepath, e, delay), 1)
+                    time.sleep(delay)
+
+            with self._lock:
+                self.failed += 1
+            log('Giving up moving {} to {}, file left in spool'.format(filepath, self.data_root))
+        finally:
+            with self._lock:
+                if self._pending.get(filepath) is token:
+                    del self._pending[filepath]
+
+    def _copy(self, source, target, block_size=1 << 20):
+        target_path = path.dirname(target)
+        if not path.exists(target_path):
+            os.makedirs(target_path)
+
+        partial_target = target + '.part'
+        checksum = hashlib.md5()
+
+        with open(source, 'rb') as fs, open(partial_target, 'wb') as ft:
+            while True:
+                block = fs.read(block_size)
+                if not block:
+                    break
+                checksum.update(block)
+                ft.write(block)
+
+        size = os.path.getsize(source)
+        if os.path.getsize(partial_target) != size:
+            raise IOError('size mismatch')
+
+        if self.verify and self._checksum(partial_target, block_size) != checksum.hexdigest():
+            raise IOError('checksum mismatch')
+
+        shutil.copystat(source, partial_target)
+        os.replace(partial_target, target)
+        with self._lock:
+            self.bytes_moved += size
+
+    @staticmethod
+    def _checksum(filepath, block_size):
+        checksum = hashlib.md5()
+        with open(filepath, 'rb') as f:
+            while True:
+                block = f.read(block_size)
+                if not block:
+                    break
+                checksum.update(block)
+        return checksum.hexdigest()
@@ -0,0 +1,241 @@
+from __future__ import division, print_function
+import time
+
+import numpy as np
+import h5py
+
+from gage_util import count_dtype, get_field_name, log
+import gage_trace as trace
+
+
+def index_dtype(num_triggers):
+    # One row per iteration: POSIX timestamp of every trigger step (NaN if missed), the missed-trigger flags, the
+    # time spent writing the iteration and its compression ratio (bytes of data over bytes stored, NaN if none)
+    return np.dtype([
+        ('iteration', np.int64),
+        ('timestamp', np.float64, (num_triggers,)),
+        ('missed', np.bool_, (num_triggers,)),
+        ('write_time', np.float64),
+        ('compression_ratio', np.float64),
+    ])
+
+
+class GageRunStore(object):
+    """
+    Run-level HDF5 store. Every segment of every trigger step is kept in a resizable, chunked dataset
+    ch{cid}/{prefix}_{segment} of shape (iterations, samples), and each saved iteration appends one row
+    to all datasets and to the 'index' table.
+
+    With swmr=True the file is switched to single-writer/multiple-reader mode once all datasets are created, so
+    GageRunReader can follow the run while it is written. Flushes (which make new rows visible to readers) are
+    limited to one per flush_interval seconds; rows appended since the last flush are flushed by a later call
+    (see unflushed), so the owner has to call flush() again after a pause.
+    """
+
+    def __init__(self, filename, triggers, swmr=False, flush_interval=None):
+        self.filename = filename
+        self.triggers = triggers
+        self.swmr = swmr
+        self.flush_interval = flush_interval
+
+        self._hf = h5py.File(filename, 'a', libver='latest' if swmr else None)
+        self._datasets = {}
+        self._index = None
+        self._counts = None
+        self._last_flush = 0.0
+        self.unflushed = False  # Rows appended since the last flush
+
+        if 'index' in self._hf:
+            self._index = self._hf['index']
+            self._counts = self._hf.get('photon_counts')
+            for cid_name, hg in self._hf.items():
+                if isinstance(hg, h5py.Group):
+                    for name, dset in hg.items():
+                        self._datasets[(cid_name, name)] = dset
+
+            self._start_swmr()
+
+    def __del__(self):
+        log('GageRunStore Deleted', 7)
+
+    @property
+    def rows(self):
+        return 0 if self._index is None else self._index.shape[0]
+
+    def close(self):
+        if self._hf is not None:
+            self._hf.close()
+            self._hf = None
+
+    def _init_file(self, iteration):
+        iteration.write_attrs(self._hf)
+        self._hf.attrs['prefixes'] = [prefix for prefix, timeout in self.triggers]
+        self._index = self._hf.create_dataset('index', shape=(0,), maxshape=(None,),
+                                              dtype=index_dtype(len(self.triggers)), chunks=(256,))
+        self._counts = self._hf.create_dataset('photon_counts', shape=(0,), maxshape=(None,), dtype=count_dtype(),
+                                               chunks=(1024,))
+
+        # Create the datasets of all trigger steps up front, no new objects can be added in SWMR mode
+        capture = iteration.first_capture()
+        for cid, config in capture.channel_config.items():
+            for name, x0, dx, seg_data in capture.get_segments(cid):
+                for prefix, timeout in self.triggers:
+                    self._require_dataset(config, get_field_name(prefix, name), len(seg_data), x0, dx,
+                                          seg_data.dtype)
+
+        self._start_swmr()
+
+    def _start_swmr(self):
+        if not self.swmr:
+            return
+
+        try:
+            self._hf.swmr_mode = True
+        except (ValueError, RuntimeError) as e:
+            log('Could not enable SWMR mode for {}: {}'.format(self.filename, e))
+
+    def _require_dataset(self, config, name, length, x0, dx, dtype):
+        group_name = 'ch{}'.format(config.id)
+        key = (group_name, name)
+        if key not in self._datasets:
+            if self._hf.swmr_mode:
+                raise KeyError('Cannot add dataset {}/{} in SWMR mode'.format(group_name, name))
+
+            hg = self._hf.require_group(group_name)
+            dset = hg.create_dataset(name, shape=(self.rows, length), maxshape=(None, length),
+                                     dtype=dtype, **config.dataset_options(length, rows=1))
+            dset.attrs['x0'] = x0
+            dset.attrs['dx'] = dx
+            self._datasets[key] = dset
+
+        return self._datasets[key]
+
+    def flush(self, force=False):
+        if self._hf is None:
+            return
+
+        now = time.perf_counter()
+        if force or self.flush_interval is None or now - self._last_flush >= self.flush_interval:
+            self._hf.flush()
+            self._last_flush = now
+            self.unflushed = False
+
+    @trace.traced('GageRunStore.append')
+    def append(self, iteration, number, flush=True):
+        if self._index is None:
+            self._init_file(iteration)
+
+        write_start = time.perf_counter()
+        row = self.rows
+        entry = np.zeros((), dtype=self._index.dtype)
+        entry['iteration'] = number
+        entry['timestamp'] = np.nan
+        logical_bytes = 0
+        stored_bytes = 0
+
+        for idx, values in enumerate(self.triggers):
+            prefix, timeout = values
+
+            if idx not in iteration.captures:
+                entry['missed'][idx] = True
+                continue
+
+            capture = iteration.captures[idx]
+            entry['timestamp'][idx] = capture.timestamp.timestamp()
+
+            for cid, config in capture.channel_config.items():
+                for name, x0, dx, seg_data in capture.get_segments(cid):
+                    try:
+                        dset = self._require_dataset(config, get_field_name(prefix, name), len(seg_data), x0, dx,
+                                                     seg_data.dtype)
+                    except KeyError as e:
+                        log(e, 1)
+                        continue
+                    stored_start = dset.id.get_storage_size()
+                    dset.resize(row + 1, axis=0)
+
+                    length = min(len(seg_data), dset.shape[1])
+                    if length < len(seg_data):
+                        log('Segment {} longer than run dataset, truncated'.format(dset.name), 1)
+                    dset[row, :length] = seg_data[:length]
+
+                    logical_bytes += dset.shape[1] * dset.dtype.itemsize
+                    stored_bytes += dset.id.get_storage_size() - stored_start
+
+        # Keep all datasets aligned with the index, also for segments missing in this iteration
+        for dset in self._datasets.values():
+            if dset.shape[0] < row + 1:
+                dset.resize(row + 1, axis=0)
+
+        # The index row is written last, so a reader that sees it also sees the data of the iteration
+        # The index of stores appended to from before these fields were added does not have them
+        if 'write_time' in entry.dtype.names:
+            entry['write_time'] = time.perf_counter() - write_start
+        if 'compression_ratio' in entry.dtype.names:
+            entry['compression_ratio'] = logical_bytes / stored_bytes if stored_bytes > 0 else np.nan
+
+        self._index.resize(row + 1, axis=0)
+        self._index[row] = entry
+        self.unflushed = True
+        if flush:
+            self.flush()
+
+
+    def append_counts(self, counts):
+        # Photon counts (see count_dtype) of an iteration, after append
+        if self._counts is None:
+            log('No photon_counts table in {}'.format(self.filename), 1)
+            return
+
+        rows = self._counts.shape[0]
+        self._counts.resize(rows + len(counts), axis=0)
+        self._counts[rows:] = counts
+        self.unflushed = True
+
+
+class GageRunReader(object):
+    """
+    Reader for a GageRunStore file that is still being written. Open it in SWMR mode, and call poll() (or iterate
+    over follow()) to pick up iterations as the writer flushes them.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._hf = h5py.File(filename, 'r', libver='latest', swmr=True)
+        self.index = self._hf['index']
+        self.rows = 0
+
+    def close(self):
+        self._hf.close()
+
+    def poll(self):
+        # Returns the index entries of iterations added since the last poll
+        self.index.refresh()
+        rows = self.index.shape[0]
+        entries = self.index[self.rows:rows]
+        self.rows = rows
+        return entries
+
+    def read(self, channel, name, rows=slice(None)):
+        dset = self._hf['ch{}'.format(channel)][name]
+        dset.refresh()
+        return dset[rows]
+
+    def follow(self, interval=1.0, timeout=None):
+        # Yields (row, index entry) for every iteration, waiting for new ones until no iteration was added for
+        # timeout seconds (forever if None)
+        last_update = time.perf_counter()
+
+        while True:
+            start = self.rows
+            entries = self.poll()
+
+            for offset, entry in enumerate(entries):
+                yield start + offset, entry
+
+            if len(entries) > 0:
+                last_update = time.perf_counter()
+            elif timeout is not None and time.perf_counter() - last_update > timeout:
+                return
+
+            time.sleep(interval)
@@ -0,0 +1,226 @@
+from __future__ import division, print_function
+import csv
+import threading
+import time
+
+import numpy as np
+import h5py
+
+# Latency instrumentation of the capture pipeline. Every GageCapture is stamped with time.perf_counter_ns() as it
+# passes the stages below, and each stamp records the time since the preceding stage of the same capture in a
+# per-stage histogram. 'total' is the time from the trigger callback to the capture being drawn. Saves run on the
+# writer thread, in TRAD mode before filtering and in SEG mode only once the iteration is complete, so 'save' is the
+# time from 'save_start', stamped when the write of the capture begins, to its end.
+
+STAGES = ('trigger', 'download', 'rearm', 'resample', 'filter', 'save', 'plot')
+PREDECESSOR = {
+    'download': 'trigger',
+    'rearm': 'download',
+    'resample': 'rearm',
+    'filter': 'resample',
+    'save': 'save_start',
+    'plot': 'filter',
+}
+assert all(stage in PREDECESSOR for stage in STAGES[1:])
+
+
+class LatencyHistogram(object):
+    """
+    Log-linear (HDR-style) histogram of durations in ns: every power of 2 is split into 2**sub_bits buckets, which
+    keeps the relative error below 2**-sub_bits over the whole range at a fixed size. record() is O(1).
+    """
+
+    def __init__(self, sub_bits=5, max_exponent=40):
+        self.sub_bits = sub_bits
+        self.sub_buckets = 1 << sub_bits
+        self.counts = np.zeros((max_exponent + 1) * self.sub_buckets, dtype=np.int64)
+        self.total = 0
+        self.max = 0
+
+    def _index(self, value):
+        if value < self.sub_buckets:
+            return value
+        exponent = value.bit_length() - 1
+        sub = (value >> (exponent - self.sub_bits)) - self.sub_buckets
+        return min((exponent - self.sub_bits + 1) * self.sub_buckets + sub, len(self.counts) - 1)
+
+    def lower_bounds(self):
+        # Smallest value of every bucket
+        index = np.arange(len(self.counts))
+        octave, sub = np.divmod(index, self.sub_buckets)
+        shift = np.maximum(octave - 1, 0)
+        return np.where(octave == 0, index, (self.sub_buckets + sub) << shift)
+
+    def record(self, value):
+        value = max(int(value), 0)
+        self.counts[self._index(value)] += 1
+        self.total += 1
+        self.max = max(self.max, value)
+
+    def percentile(self, p):
+        if self.total == 0:
+            return 0
+        rank = int(np.ceil(p / 100.0 * self.total))
+        bucket = np.searchsorted(np.cumsum(self.counts), max(rank, 1))
+        return int(self.lower_bounds()[bucket])
+
+    def reset(self):
+        self.counts[:] = 0
+        self.total = 0
+        self.max = 0
+
+    def copy(self):
+        histogram = LatencyHistogram.__new__(LatencyHistogram)
+        histogram.__dict__.update(self.__dict__)
+        histogram.counts = self.counts.copy()
+        return histogram
+
+
+class PipelineTimer(object):
+    # Per-stage LatencyHistograms, shared by the threads of the pipeline
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.histograms = {stage: LatencyHistogram() for stage in STAGES[1:] + ('total',)}
+
+    def record(self, stage, stamps):
+        # Called by GageCapture.stamp with the stamps of the capture so far
+        previous = PREDECESSOR.get(stage)
+        if previous not in stamps:
+            return
+
+        with self._lock:
+            self.histograms[stage].record(stamps[stage] - stamps[previous])
+            if stage == 'plot' and 'trigger' in stamps:
+                self.histograms['total'].record(stamps[stage] - stamps['trigger'])
+
+    def reset(self):
+        with self._lock:
+            for histogram in self.histograms.values():
+                histogram.reset()
+
+    def copy(self):
+        # Snapshot to save while the pipeline keeps recording
+        timer = PipelineTimer()
+        with self._lock:
+            timer.histograms = {stage: histogram.copy() for stage, histogram in self.histograms.items()}
+        return timer
+
+    def summary(self, percentiles=(50, 99)):
+        # Returns {stage: (count, percentiles in ms...)} of the stages with data
+        with self._lock:
+            return {stage: (histogram.total,) + tuple(histogram.percentile(p) / 1e6 for p in percentiles)
+                    for stage, histogram in self.histograms.items() if histogram.total > 0}
+
+    def empty_stages(self):
+        # Stages that got no samples
+        with self._lock:
+            return [stage for stage in STAGES[1:] + ('total',) if self.histograms[stage].total == 0]
+
+    def status(self):
+        summary = self.summary()
+        stages = [stage for stage in STAGES[1:] + ('total',) if stage in summary]
+        return ' '.join('{} {:.1f}/{:.1f}'.format(stage, summary[stage][1], summary[stage][2]) for stage in stages)
+
+    def dump_csv(self, filename, percentiles=(50, 90, 99)):
+        # One row per stage: count, percentiles and max in ms
+        with self._lock:
+            with open(filename, 'w', newline='') as f:
+                writer = csv.writer(f)
+                writer.writerow(['stage', 'count'] + ['p{:g}_ms'.format(p) for p in percentiles] + ['max_ms'])
+                for stage, histogram in self.histograms.items():
+                    writer.writerow([stage, histogram.total] +
+                                    ['{:.3f}'.format(histogram.percentile(p) / 1e6) for p in percentiles] +
+                                    ['{:.3f}'.format(histogram.max / 1e6)])
+
+    def dump_h5(self, filename):
+        # Full histograms: lower bound of every bucket in ns, and the counts per stage
+        with self._lock:
+            with h5py.File(filename, 'w') as hf:
+                hf.attrs['created'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+                histograms = list(self.histograms.values())
+                hf.create_dataset('bucket_ns', data=histograms[0].lower_bounds())
+                for stage, histogram in self.histograms.items():
+                    dset = hf.create_dataset(stage, data=histogram.counts)
+                    dset.attrs['count'] = histogram.total
+                    dset.attrs['max_ns'] = histogram.max
+
+
+class RunStatistics(object):
+    """
+    Trigger accounting of a run: triggers seen by the worker, extra triggers, triggers missed by timeout and by a
+    skip in the trigger sequence, captures dropped because the worker queue was full, and the distribution of the
+    dead time from the acquisition callback to re-arming the board.
+
+    A dropped capture also leaves a gap in the trigger sequence. Every trigger is counted once: the worker reports
+    the drops in front of each capture with captured(), and missed triggers explained by them are taken off the
+    missed counts (timeouts counted since the previous capture first, then skips detected with this capture).
+    """
+
+    COUNTERS = ('seen', 'extra', 'missed_timeout', 'missed_skip', 'queue_drops')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = dict.fromkeys(self.COUNTERS, 0)
+        self.dead_time = LatencyHistogram()
+
+        self._timeouts = 0  # Timeouts counted since the previous capture
+        self._drops = 0  # Drops in front of the current capture not yet matched with missed triggers
+
+    def count(self, name, n=1):
+        with self._lock:
+            if name == 'missed_timeout':
+                self._timeouts += n
+            elif name == 'missed_skip':
+                matched = min(n, self._drops)
+                self._drops -= matched
+                n -= matched
+            self.counters[name] += n
+
+    def captured(self, dropped):
+        # Called by the worker for every capture, with the number of captures dropped since the previous one
+        with self._lock:
+            matched = min(dropped, self._timeouts)
+            self.counters['missed_timeout'] -= matched
+            self._drops = dropped - matched
+            self._timeouts = 0
+
+    def record_dead_time(self, ns):
+        with self._lock:
+            self.dead_time.record(ns)
+
+    def reset(self):
+        with self._lock:
+            self.counters = dict.fromkeys(self.COUNTERS, 0)
+            self.dead_time.reset()
+            self._timeouts = 0
+            self._drops = 0
+
+    def copy(self):
+        stats = RunStatistics()
+        with self._lock:
+            stats.counters = dict(self.counters)
+            stats.dead_time = self.dead_time.copy()
+        return stats
+
+    def status(self):
+        with self._lock:
+            counters = dict(self.counters)
+            dead_time = (self.dead_time.percentile(50) / 1e6, self.dead_time.percentile(99) / 1e6)
+        return ('Triggers: {seen:d} seen, {extra:d} extra, {missed_timeout:d}/{missed_skip:d} missed (timeout/skip), '
+                '{queue_drops:d} dropped | Dead time p50/p99 (ms): {0:.1f}/{1:.1f}'.format(*dead_time, **counters))
+
+    def dump_h5(self, filename):
+        # Counters as attributes, the dead time histogram as lower bound of every bucket in ns and counts
+        with self._lock:
+            with h5py.File(filename, 'w') as hf:
+                hf.attrs['created'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+                for name, value in self.counters.items():
+                    hf.attrs[name] = value
+
+                hf.create_dataset('dead_time_bucket_ns', data=self.dead_time.lower_bounds())
+                dset = hf.create_dataset('dead_time', data=self.dead_time.counts)
+                dset.attrs['count'] = self.dead_time.total
+                dset.attrs['max_ns'] = self.dead_time.max
+                for p in (50, 90, 99):
+                    dset.attrs['p{:d}_ns'.format(p)] = self.dead_time.percentile(p)
@@ -0,0 +1,141 @@
+from __future__ import division, print_function
+import itertools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+import numpy as np
+
+# Opt-in timeline tracer. While enabled, span() and @traced record begin/end events with the native thread id into a
+# preallocated ring, which dump() writes out in Chrome Trace Event format (load it in chrome://tracing or Perfetto).
+# Disabled, a span costs one global lookup.
+
+_tracer = None
+
+
+class Tracer(object):
+
+    def __init__(self, size=1 << 16):
+        self.size = int(size)
+        self.names = []
+        self._name_index = {}
+        self.thread_names = {}
+
+        self._name_id = np.zeros(self.size, dtype=np.int32)
+        self._phase = np.zeros(self.size, dtype='S1')
+        self._ts = np.zeros(self.size, dtype=np.int64)
+        self._tid = np.zeros(self.size, dtype=np.int64)
+
+        self._counter = itertools.count()  # next() is atomic, so threads never share a slot
+        self._lock = threading.Lock()
+        self.start_ns = time.perf_counter_ns()
+
+    def _name(self, name):
+        index = self._name_index.get(name)
+        if index is None:
+            with self._lock:
+                if name not in self._name_index:
+                    self._name_index[name] = len(self.names)
+                    self.names.append(name)
+                index = self._name_index[name]
+        return index
+
+    def record(self, name, phase):
+        ts = time.perf_counter_ns()
+        tid = threading.get_native_id()
+        if tid not in self.thread_names:
+            self.thread_names[tid] = threading.current_thread().name
+
+        slot = next(self._counter)
+        idx = slot % self.size
+        self._name_id[idx] = self._name(name)
+        self._ts[idx] = ts
+        self._tid[idx] = tid
+        self._phase[idx] = phase  # Last, a slot with a phase is complete
+
+    def events(self):
+        # Recorded events in order, oldest first. Events overwritten by the ring are lost, so end events can
+        # appear without their begin.
+        order = np.flatnonzero(self._phase != b'')
+        order = order[np.argsort(self._ts[order], kind='stable')]
+
+        pid = os.getpid()
+        events = [{'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': thread_name}}
+                  for tid, thread_name in list(self.thread_names.items())]
+        for idx in order:
+            events.append({
+                'name': self.names[self._name_id[idx]],
+                'ph': self._phase[idx].decode(),
+                'ts': (self._ts[idx] - self.start_ns) / 1e3,  # us
+                'pid': pid,
+                'tid': int(self._tid[idx]),
+            })
+        return events
+
+    def dump(self, filename):
+        with open(filename, 'w') as f:
+            json.dump({'traceEvents': self.events(), 'displayTimeUnit': 'ms'}, f)
+
+
+def enable(size=1 << 16):
+    global _tracer
+    _tracer = Tracer(size)
+    return _tracer
+
+
+def disable():
+    global _tracer
+    _tracer = None
+
+
+def enabled():
+    return _tracer is not None
+
+
+def dump(filename):
+    if _tracer is not None:
+        _tracer.dump(filename)
+
+
+@contextmanager
+def _span(tracer, name):
+    tracer.record(name, b'B')
+    try:
+        yield
+    finally:
+        tracer.record(name, b'E')
+
+
+class _NullSpan(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+_null_span = _NullSpan()
+
+
+def span(name):
+    tracer = _tracer
+    if tracer is None:
+        return _null_span
+    return _span(tracer, name)
+
+
+def traced(name=None):
+    # Decorator recording a span around every call of the function
+    def decorator(func):
+        span_name = name if name is not None else func.__qualname__
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(span_name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
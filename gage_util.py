@@ -1,26 +1,177 @@
 from __future__ import division,print_function
 from enum import IntEnum
+from collections import deque
+import atexit
+import copy
+import logging
+import logging.handlers
 import math
 import os
+import queue
 import sys
+import threading
+import time
 from configparser import ConfigParser
-from datetime import datetime
 	
 import numpy as np
 import pyqtgraph as pg
-from scipy import signal
+from scipy import fft, signal
 
 def get_script_path():
 	return os.path.dirname(os.path.realpath(sys.argv[0]))
 
 ####################
 
-print_level = 10
+# Logging. log() only filters and appends the message to a queue; a background thread formats it and writes it to the
+# console and, after setup_logging(), to a rotating log file. Messages of a subsystem (the name of the calling module,
+# also for scripts run as __main__) are logged up to debug level log_levels[subsystem], or print_level if not given.
 
-def log(msg, debug_level=0):
-	if debug_level <= print_level:
-		timestamp = datetime.now()	
-		print('{}: {}'.format(timestamp, msg))
+print_level = 10
+log_levels = {}
+
+_log_queue = queue.SimpleQueue()
+_log_handlers = []
+_log_thread = None
+_log_lock = threading.Lock()
+_log_stopped = False  # Set by stop_logging, after which messages are written on the calling thread
+# key -> (time of last logged message, rate_limit, number of messages suppressed since, last suppressed message).
+# Guarded by _log_lock.
+_rate_limits = {}
+_suppressed_interval = 1.0  # How often (s) the log thread reports messages suppressed since the last one logged
+
+def log(msg, debug_level=0, subsystem=None, rate_limit=None, key=None):
+	# rate_limit (s): log repeats of the same message (or the same key) at most once per rate_limit. If no repeat
+	# follows, the number suppressed is reported by the log thread once rate_limit has passed.
+	if subsystem is None:
+		caller = sys._getframe(1).f_globals
+		subsystem = caller.get('__name__', '')
+		if subsystem == '__main__' and caller.get('__file__'):
+			subsystem = os.path.splitext(os.path.basename(caller['__file__']))[0]
+	if debug_level > log_levels.get(subsystem, print_level):
+		return
+
+	now = time.time()
+	if rate_limit is not None:
+		key = (subsystem, msg if key is None else key)
+		with _log_lock:
+			last, _, suppressed, _ = _rate_limits.get(key, (None, None, 0, None))
+			if last is not None and now - last < rate_limit:
+				_rate_limits[key] = (last, rate_limit, suppressed + 1, (debug_level, msg))
+				return
+			_rate_limits[key] = (now, rate_limit, 0, None)
+		if suppressed > 0:
+			msg = '{} ({:d} similar messages suppressed)'.format(msg, suppressed)
+
+	item = (now, subsystem, debug_level, threading.current_thread().name, msg)
+	if _log_stopped:
+		# Shutting down (e.g. __del__ during interpreter finalization), never start the thread again
+		_emit(item)
+		return
+	if _log_thread is None:
+		_start_logging()
+	_log_queue.put(item)
+
+def _start_logging():
+	global _log_thread
+	with _log_lock:
+		if _log_thread is not None or _log_stopped:
+			return
+		if not _log_handlers:
+			_log_handlers.append(_console_handler())
+
+		_log_thread = threading.Thread(target=_log_loop, name='GageLog', daemon=True)
+		_log_thread.start()
+
+def _console_handler():
+	handler = logging.StreamHandler(sys.stdout)
+	handler.setFormatter(logging.Formatter('%(asctime)s.%(msecs)03d: %(message)s', '%Y-%m-%d %H:%M:%S'))
+	return handler
+
+def _log_loop():
+	checked = time.time()
+	while True:
+		try:
+			item = _log_queue.get(timeout=_suppressed_interval)
+		except queue.Empty:
+			item = False
+		if item is None:
+			_report_suppressed(time.time(), True)
+			break
+		if item:
+			_emit(item)
+
+		now = time.time()
+		if now - checked >= _suppressed_interval:
+			_report_suppressed(now)
+			checked = now
+
+def _report_suppressed(now, flush=False):
+	# Logs the messages suppressed by rate limits that have passed since (all of them if flush is set), and forgets
+	# the keys without pending messages
+	items = []
+	with _log_lock:
+		for key, (last, rate_limit, suppressed, pending) in list(_rate_limits.items()):
+			if not flush and now - last < rate_limit:
+				continue
+			del _rate_limits[key]
+			if suppressed > 0:
+				debug_level, msg = pending
+				items.append((now, key[0], debug_level, 'GageLog',
+					'{} ({:d} similar messages suppressed)'.format(msg, suppressed)))
+	for item in items:
+		_emit(item)
+
+def _emit(item):
+	created, subsystem, debug_level, thread_name, msg = item
+	record = logging.makeLogRecord({'name': subsystem, 'msg': msg, 'levelno': logging.INFO - debug_level,
+		'levelname': 'L{:d}'.format(debug_level), 'created': created, 'msecs': (created % 1) * 1000,
+		'threadName': thread_name})
+	for handler in list(_log_handlers):
+		try:
+			handler.handle(record)
+		except Exception:
+			handler.handleError(record)
+
+def setup_logging(filename=None, max_bytes=10 * 1024 * 1024, backup_count=5, console=True):
+	# Log to the console and/or to filename, rotated when it reaches max_bytes, keeping backup_count old files
+	handlers = []
+	if console:
+		handlers.append(_console_handler())
+	if filename is not None:
+		if os.path.dirname(filename) and not os.path.exists(os.path.dirname(filename)):
+			os.makedirs(os.path.dirname(filename))
+		handler = logging.handlers.RotatingFileHandler(filename, maxBytes=max_bytes, backupCount=backup_count)
+		handler.setFormatter(logging.Formatter('%(asctime)s.%(msecs)03d %(levelname)s %(threadName)s %(name)s: %(message)s',
+			'%Y-%m-%d %H:%M:%S'))
+		handlers.append(handler)
+
+	# Swapped in whole, the log thread picks the new handlers up with the next message
+	global _log_stopped
+	_log_handlers[:] = handlers
+	_log_stopped = False
+	_start_logging()
+
+def stop_logging():
+	# Writes out the queued messages and stops the log thread. Later messages are written synchronously.
+	global _log_thread, _log_stopped
+	with _log_lock:
+		_log_stopped = True
+		thread, _log_thread = _log_thread, None
+	if thread is None:
+		return
+	# Not joined under _log_lock, which the log thread takes to report suppressed messages
+	_log_queue.put(None)
+	thread.join()
+	for handler in _log_handlers:
+		handler.flush()
+
+atexit.register(stop_logging)
+
+def get_field_name(field_prefix, field_name):
+	if len(field_prefix) > 0:
+		return "{}_{}".format(field_prefix, field_name)
+	else:
+		return field_name
 
 ####################
 
@@ -55,10 +206,226 @@ def e3decimate(x, q, n=None, axis=-1, zero_phase=True):
 
 	return y[tuple(sl)]
 
+def e3decimate_blocks(x, q, n=None, block_size=1 << 20, lookahead=None):
+	# Streaming equivalent of e3decimate(x, q, n) for 1D x (e.g. a memory map). Yields the decimated output in
+	# consecutive blocks, keeping only block_size + lookahead samples in memory.
+	# The forward filter pass runs once over the signal with carried state. The backward pass of each block starts
+	# lookahead samples past its end, where its initial state is approximated; the error decays within the lookahead.
+	q = int(q)
+	n = 8 if n is None else int(n)
+	
+	length = len(x)
+	if lookahead is None:
+		lookahead = 16 * q * n
+	block_size = max(q, block_size // q * q) # Blocks start at multiples of q, to keep the decimation phase
+	
+	if length <= block_size + lookahead:
+		yield e3decimate(np.asarray(x[:], dtype=np.double), q, n=n)
+		return
+	
+	sos = signal.butter(n, 0.8 / q, output='sos')
+	zi = signal.sosfilt_zi(sos)
+	# Odd extension at the ends, as in sosfiltfilt
+	padlen = 3 * (2 * len(sos) + 1 - min((sos[:, 2] == 0).sum(), (sos[:, 5] == 0).sum()))
+	
+	head = np.asarray(x[:padlen + 1], dtype=np.double)
+	ext = 2 * head[0] - head[padlen:0:-1]
+	_, state = signal.sosfilt(sos, ext, zi=zi * ext[0])
+	
+	forward = np.zeros(0) # Forward filtered samples from position start onwards
+	forward_end = 0 # Input position up to which the forward pass has run
+	
+	for start in range(0, length, block_size):
+		stop = min(start + block_size, length)
+		end = min(stop + lookahead, length)
+		
+		if end > forward_end:
+			y, state = signal.sosfilt(sos, np.asarray(x[forward_end:end], dtype=np.double), zi=state)
+			forward = np.concatenate((forward, y))
+			forward_end = end
+		
+		if end == length:
+			tail = np.asarray(x[length - padlen - 1:], dtype=np.double)
+			ext = 2 * tail[-1] - tail[-2::-1]
+			y_ext, _ = signal.sosfilt(sos, ext, zi=state)
+			backward_in = np.concatenate((forward, y_ext))
+		else:
+			backward_in = forward
+		
+		y = signal.sosfilt(sos, backward_in[::-1], zi=zi * backward_in[-1])[0][::-1]
+		yield y[:stop - start:q]
+		
+		forward = forward[stop - start:]
+
+def minmax_pyramid(x, factors=(16, 256, 4096)):
+	# Returns [(factor, (bins, 2) array of min and max of every factor samples)] for increasing factors.
+	# Each level is reduced from the previous one, so the raw data is only scanned once. The last bin of a level
+	# covers the remaining samples if len(x) is not a multiple of the factor.
+	levels = []
+	lo = hi = np.asarray(x)
+	step = 1
+	
+	for factor in sorted(factors):
+		if factor % step != 0:
+			raise ValueError('Preview factors must be multiples of each other')
+		
+		q = factor // step
+		full = len(lo) // q * q
+		bins = -(-len(lo) // q)
+		
+		new_lo = np.empty(bins, dtype=lo.dtype)
+		new_hi = np.empty(bins, dtype=hi.dtype)
+		new_lo[:full // q] = lo[:full].reshape(-1, q).min(axis=1)
+		new_hi[:full // q] = hi[:full].reshape(-1, q).max(axis=1)
+		if full < len(lo):
+			new_lo[-1] = lo[full:].min()
+			new_hi[-1] = hi[full:].max()
+		
+		lo, hi, step = new_lo, new_hi, factor
+		levels.append((factor, np.stack((lo, hi), axis=1)))
+		
+		if bins <= 1:
+			break
+	
+	return levels
+
+class TraceHistogram(object):
+	# Persistence histogram of many traces: counts of (time bin, amplitude bin) over all added traces. Each trace
+	# costs one binning pass, independent of the number of traces accumulated. With decay (0 < decay < 1) the
+	# counts are scaled by decay before every trace is added, so old traces fade out. Decayed counts are kept as
+	# float32, which would otherwise truncate single hits to 0 on the next trace.
+	
+	def __init__(self, time_bins=1000, amplitude_bins=256, x_range=None, y_range=None, decay=None):
+		self.shape = (int(time_bins), int(amplitude_bins))
+		self.x_range = x_range
+		self.y_range = y_range
+		self.decay = decay
+		
+		self.counts = np.zeros(self.shape, dtype=np.uint32 if decay is None else np.float32)
+		self.traces = 0
+	
+	def clear(self):
+		self.counts[:] = 0
+		self.traces = 0
+	
+	def add(self, t, data):
+		t = np.asarray(t, dtype=np.double)
+		data = np.asarray(data, dtype=np.double)
+		if len(t) == 0:
+			return
+		
+		# Unset ranges are taken from the first trace
+		if self.x_range is None:
+			self.x_range = (t.min(), t.max())
+		if self.y_range is None:
+			y_min, y_max = np.nanmin(data), np.nanmax(data)
+			margin = 0.1 * (y_max - y_min) if y_max > y_min else 1.0
+			self.y_range = (y_min - margin, y_max + margin)
+		
+		nx, ny = self.shape
+		x0, x1 = self.x_range
+		y0, y1 = self.y_range
+		ix = np.floor((t - x0) * (nx / (x1 - x0 or 1.0)))
+		iy = np.floor((data - y0) * (ny / (y1 - y0 or 1.0)))
+		
+		# Samples outside the ranges are dropped, the last time bin includes x1
+		ix[t == x1] = nx - 1
+		valid = (ix >= 0) & (ix < nx) & (iy >= 0) & (iy < ny)
+		index = ix[valid].astype(np.intp) * ny + iy[valid].astype(np.intp)
+		
+		if self.decay is not None:
+			self.counts *= self.decay
+		self.counts += np.bincount(index, minlength=nx * ny).reshape(self.shape).astype(self.counts.dtype)
+		self.traces += 1
+
+class RunningAverage(object):
+	# Running mean and variance (Welford) of traces of equal length. Restarts if the length changes.
+	
+	def __init__(self):
+		self.count = 0
+		self.t = None
+		self.mean = None
+		self.m2 = None
+	
+	def update(self, t, data):
+		data = np.asarray(data, dtype=np.float64)
+		if self.mean is None or len(data) != len(self.mean):
+			self.count = 0
+			self.t = np.array(t, dtype=np.float64)
+			self.mean = np.zeros(len(data))
+			self.m2 = np.zeros(len(data))
+		
+		self.count += 1
+		delta = data - self.mean
+		self.mean += delta / self.count
+		self.m2 += delta * (data - self.mean)
+	
+	@property
+	def variance(self):
+		if self.count < 2:
+			return np.zeros_like(self.mean)
+		return self.m2 / (self.count - 1)
+	
+	@property
+	def std(self):
+		return np.sqrt(self.variance)
+
+def count_dtype(name_length=32):
+	# Photon counts of one segment of one capture
+	return np.dtype([
+		('iteration', np.int64),
+		('timestamp', np.float64),
+		('trigger', np.int32),
+		('channel', np.int32),
+		('segment', 'S{:d}'.format(name_length)),
+		('count', np.int64),
+		('saturated', np.bool_),
+	])
+
+class RingBuffer(object):
+	# Fixed size buffer of the last size rows of a structured dtype. append is O(1), values() returns the rows in
+	# insertion order.
+	
+	def __init__(self, size, dtype):
+		self.data = np.zeros(int(size), dtype=dtype)
+		self.head = 0
+		self.count = 0
+	
+	def __len__(self):
+		return self.count
+	
+	def append(self, row):
+		self.data[self.head] = row
+		self.head = (self.head + 1) % len(self.data)
+		self.count = min(self.count + 1, len(self.data))
+	
+	def clear(self):
+		self.head = 0
+		self.count = 0
+	
+	def values(self):
+		if self.count < len(self.data):
+			return self.data[:self.count]
+		return np.concatenate((self.data[self.head:], self.data[:self.head]))
+
 class DisplayFilter(object):
+	# Axis of the filter output, as shown by ChannelWidget
+	time_domain = True
+	x_label = ('Time', 's')
+	y_label = ('Signal', 'V')
+	log_y = False
 		
 	def apply(self, sample_rate, t, data):
 		return (t, data)
+	
+	def average_grid(self, t, data):
+		# Output of apply on a grid that is the same for every trace, for running averages
+		return (t, data)
+	
+	def for_line(self, line):
+		# Filter to apply to a line (trigger step) of the channel. Filters that average over captures keep one
+		# instance per line.
+		return self
 
 class HeterodyneFilter(DisplayFilter):
 	
@@ -90,12 +457,19 @@ class HeterodyneFilter(DisplayFilter):
 
 
 class PeakIntegralFilter(DisplayFilter):
+	# Cumulative photon count from the SPCM pulses. The arrival times and saturation flag of the last trace are kept
+	# in peak_times and saturated, for the photon counts of GageCapture.count_photons.
 
-	def __init__(self, threshold, width, max_length=None):
+	def __init__(self, threshold, width, max_length=None, saturation=500, average_points=2000):
 		self.threshold = threshold
 		self.width = width
+		self.saturation = saturation
 
 		self.max_length = max_length
+		self.average_points = average_points
+
+		self.peak_times = None
+		self.saturated = False
 
 	def apply(self, sample_rate, t, data):
 		threshold = self.threshold
@@ -103,16 +477,20 @@ class PeakIntegralFilter(DisplayFilter):
 
 		peaks, _ = signal.find_peaks(data, height=threshold, distance=width, width=width)
 		num_total = len(peaks)
-		print(f"total photon number = {num_total}")
 		# t_arrivals = np.concatenate(([0],t[peaks],[t[-1]]), axis=None)
 		# num_count = np.concatenate((np.arange(num_total+1),[num_total]), axis=None)
-		if np.mean(data)>500:
-			print('SPCM saturated!!! Turn down the power!')
+		self.saturated = bool(np.mean(data) > self.saturation)
 		temp_x = t[peaks]
+		self.peak_times = temp_x
 		t_arrivals = np.concatenate(([0],np.stack((temp_x - 1e-9, temp_x)).flatten('F'),[t[-1]]), axis=None)
 		temp_y = np.arange(num_total+1)
 		num_count = np.stack((temp_y, temp_y)).flatten('F')
 		return (t_arrivals, num_count)
+	
+	def average_grid(self, t, data):
+		# The output has two points per photon, the cumulative count is sampled at average_points fixed times instead
+		grid = np.linspace(0, t[-1], self.average_points)
+		return (grid, data[np.searchsorted(t, grid, side='right') - 1])
 
 class DecimateFilter(DisplayFilter):
 
@@ -148,14 +526,117 @@ class PhotonCounter(DisplayFilter):
 		return (dec_t, filtered)
 
 
+class SpectrumFilter(DisplayFilter):
+	# Welch power spectral density, averaged over captures. Every capture is cut into segments of nperseg samples
+	# with 50% overlap, of which at most max_segments (evenly spread) are transformed, which bounds the cost per
+	# capture. averaging='exponential' weights each new PSD with alpha, 'boxcar' averages the last count PSDs.
+	# The average is kept per line, use for_line(line).apply in SEG mode. decimate > 1 low-pass filters and decimates before the FFT, for narrow spans at high resolution.
+	time_domain = False
+	x_label = ('Frequency', 'Hz')
+	y_label = ('PSD', 'V²/Hz')
+	log_y = True
+	
+	def __init__(self, nperseg=4096, window='hann', averaging='exponential', alpha=0.1, count=10, decimate=1,
+			max_segments=64):
+		self.nperseg = int(nperseg)
+		self.window = window
+		self.averaging = averaging
+		self.alpha = alpha
+		self.count = count
+		self.decimate = int(decimate)
+		self.max_segments = max_segments
+		
+		self._window = signal.get_window(self.window, self.nperseg)
+		self._nfft = fft.next_fast_len(self.nperseg, real=True)
+		self._freqs = None
+		
+		self.reset()
+	
+	def reset(self):
+		self.psd = None
+		self._history = deque()
+		self._sum = None
+		self._lines = {}
+	
+	def for_line(self, line):
+		if line not in self._lines:
+			line_filter = copy.copy(self)
+			line_filter.reset()
+			self._lines[line] = line_filter
+		return self._lines[line]
+	
+	def _welch(self, sample_rate, data):
+		nperseg = self.nperseg
+		step = nperseg // 2
+		if len(data) < nperseg:
+			data = np.pad(data, (0, nperseg - len(data)))
+		
+		segments = np.lib.stride_tricks.sliding_window_view(data, nperseg)[::step]
+		if len(segments) > self.max_segments:
+			segments = segments[np.linspace(0, len(segments) - 1, self.max_segments).astype(int)]
+		
+		segments = segments - segments.mean(axis=1, keepdims=True)
+		spectrum = fft.rfft(segments * self._window, n=self._nfft, axis=1)
+		psd = np.mean(spectrum.real ** 2 + spectrum.imag ** 2, axis=0)
+		
+		# One-sided density
+		psd *= 2.0 / (sample_rate * np.sum(self._window ** 2))
+		psd[0] /= 2
+		if self._nfft % 2 == 0:
+			psd[-1] /= 2
+		
+		return np.fft.rfftfreq(self._nfft, 1.0 / sample_rate), psd
+	
+	def apply(self, sample_rate, t, data):
+		if self.decimate > 1:
+			data = e3decimate(data, self.decimate, n=4)
+			sample_rate = sample_rate / self.decimate
+		
+		freqs, psd = self._welch(sample_rate, np.asarray(data, dtype=np.double))
+		
+		# Restart the average if the frequency axis changed
+		if self._freqs is None or len(freqs) != len(self._freqs) or freqs[-1] != self._freqs[-1]:
+			self.reset()
+			self._freqs = freqs
+		
+		if self.averaging == 'boxcar':
+			self._history.append(psd)
+			self._sum = psd.copy() if self._sum is None else self._sum + psd
+			if len(self._history) > self.count:
+				self._sum -= self._history.popleft()
+			self.psd = self._sum / len(self._history)
+		elif self.psd is None:
+			self.psd = psd
+		else:
+			self.psd = (1 - self.alpha) * self.psd + self.alpha * psd
+		
+		return (freqs, self.psd)
+
+
 class ChannelConfig(object):
-	def __init__(self, id, coupling, impedance, range, resample=None, name=None, filter=None, pen=None):
+	def __init__(self, id, coupling, impedance, range, resample=None, name=None, filter=None, pen=None,
+			chunks=None, shuffle=False, compression=None, compression_opts=None, preview=(16, 256, 4096),
+			persistence=None):
 		self.id = id
 		self.coupling = coupling
 		self.impedance = impedance
 		self.range = range
 		self.resample = resample
 		
+		# HDF5 storage options for the segment datasets: chunk length in samples, byte shuffle,
+		# compression filter ('gzip', 'lzf', ...) and its level
+		self.chunks = chunks
+		self.shuffle = shuffle
+		self.compression = compression
+		self.compression_opts = compression_opts
+		
+		# Decimation factors of the min/max preview pyramid saved with every segment (None to save none)
+		self.preview = preview
+		
+		# Persistence display: TraceHistogram arguments, e.g. dict(time_bins=1000, amplitude_bins=256, decay=0.99),
+		# or None to only show the latest traces
+		self.persistence = persistence
+		
 		if name is None:
 			self.name = 'Channel {}'.format(self.id)
 		else:
@@ -195,8 +676,29 @@ class ChannelConfig(object):
 			start, stop = (float(x) for x in span.split(","))
 			self.segments.append((name, start, stop))
 			
+	def dataset_options(self, length, rows=None):
+		# Keyword arguments for h5py create_dataset. rows is the chunk size along the iteration axis for
+		# (iterations, samples) datasets, None for a plain 1D segment.
+		options = {}
+		
+		filtered = self.shuffle or self.compression is not None
+		if self.chunks is None and not filtered and rows is None:
+			return options # Contiguous layout
+		
+		chunk = length if self.chunks is None else min(int(self.chunks), length)
+		chunk = max(chunk, 1)
+		options['chunks'] = (chunk,) if rows is None else (rows, chunk)
+		
+		if self.shuffle:
+			options['shuffle'] = True
+		if self.compression is not None:
+			options['compression'] = self.compression
+			options['compression_opts'] = self.compression_opts
+		
+		return options
+	
 	def get_pen(self, trigger=0):
-		return self.pen[trigger if trigger <= len(self.pen) else -1]
+		return self.pen[trigger if trigger < len(self.pen) else -1]
 
 class GageConfig(object):
 	
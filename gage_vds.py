@@ -0,0 +1,224 @@
+from __future__ import division, print_function
+import argparse
+import fnmatch
+import os
+import re
+import time
+from os import path
+
+import numpy as np
+import h5py
+
+from gage_preview import PREVIEW_GROUP
+from gage_util import log
+
+# Builds an HDF5 virtual dataset (VDS) index over the iteration_XXXXX.h5 files of a SEG mode run. Every segment
+# dataset ch{cid}/{prefix}_{segment} is mapped across all iterations to one (iterations, samples) virtual dataset,
+# so a run can be read with one slice. Iterations where a segment is missing read as fillvalue, and are marked in
+# present/ch{cid}/{prefix}_{segment}. The index keeps the inventory of the files it maps, with their size and
+# modification time, so updates only open files that were added or changed since the last update.
+
+INDEX_NAME = 'run_vds.h5'
+FILE_PATTERN = 'iteration_*.h5'
+
+
+def _iteration_number(filename):
+    match = re.search(r'(\d+)\.h5$', filename)
+    return int(match.group(1)) if match else -1
+
+
+def inventory_file(filepath):
+    # Returns (datasets, timestamps, attrs) of an iteration file: datasets maps 'ch{cid}/{name}' to
+    # (shape, dtype, x0, dx), timestamps the *timestamp attributes, attrs the root and channel group attributes
+    datasets = {}
+    attrs = {}
+    with h5py.File(filepath, 'r') as hf:
+        timestamps = {key: value for key, value in hf.attrs.items() if key.endswith('timestamp')}
+        attrs[''] = {key: value for key, value in hf.attrs.items() if not key.endswith('timestamp')}
+
+        for group_name, hg in hf.items():
+            if not isinstance(hg, h5py.Group) or group_name == PREVIEW_GROUP:
+                continue
+            attrs[group_name] = dict(hg.attrs)
+            for name, dset in hg.items():
+                datasets['{}/{}'.format(group_name, name)] = (dset.shape, dset.dtype, dset.attrs.get('x0', 0.0),
+                                                              dset.attrs.get('dx', 1.0))
+
+    return datasets, timestamps, attrs
+
+
+class RunIndex(object):
+    # Inventory of the iteration files of a run, as stored in the VDS index file
+
+    def __init__(self):
+        self.files = []
+        self.signatures = []  # (size, mtime) of every file when it was inventoried
+        self.datasets = {}  # key -> (shape, dtype, x0, dx)
+        self.present = {}  # key -> list of bool, one per file
+        self.timestamps = {}  # attribute -> list of str, one per file
+        self.attrs = {}
+
+    @classmethod
+    def load(cls, filename):
+        index = cls()
+        with h5py.File(filename, 'r') as hf:
+            index.files = [name.decode() for name in hf['files'][:]]
+            if 'file_size' in hf:
+                index.signatures = list(zip(hf['file_size'][:].tolist(), hf['file_mtime'][:].tolist()))
+            else:
+                index.signatures = [None] * len(index.files)  # Older index, every file is rescanned once
+            index.attrs[''] = dict(hf.attrs)
+
+            for key in _dataset_keys(hf['present']):
+                vdset = hf[key]
+                index.datasets[key] = (vdset.shape[1:], vdset.dtype, vdset.attrs['x0'], vdset.attrs['dx'])
+                index.present[key] = list(hf['present'][key][:])
+                group_name = key.split('/')[0]
+                index.attrs[group_name] = dict(hf[group_name].attrs)
+
+            for name, dset in hf['timestamps'].items():
+                index.timestamps[name] = [value.decode() for value in dset[:]]
+
+        return index
+
+    def add(self, filename, datasets, timestamps, attrs, signature=None):
+        row = len(self.files)
+        self.files.append(filename)
+        self.signatures.append(signature)
+        for values in self.present.values():
+            values.append(False)
+        for values in self.timestamps.values():
+            values.append('')
+
+        self.update(row, datasets, timestamps, attrs, signature)
+
+    def update(self, row, datasets, timestamps, attrs, signature=None):
+        # Replaces the inventory of the file in row, e.g. after it was still being written when first added
+        count = len(self.files)
+        self.signatures[row] = signature
+
+        for values in self.present.values():
+            values[row] = False
+        for key, info in datasets.items():
+            if key not in self.datasets:
+                self.datasets[key] = info
+                self.present[key] = [False] * count
+            elif info[0] != self.datasets[key][0]:
+                continue  # Shape differs from the rest of the run, leave it out
+            self.present[key][row] = True
+
+        for name in set(self.timestamps) | set(timestamps):
+            self.timestamps.setdefault(name, [''] * count)[row] = str(timestamps.get(name, ''))
+
+        for group_name, values in attrs.items():
+            self.attrs.setdefault(group_name, values)
+
+    def write(self, filename, fillvalue=0):
+        partial_file = filename + '.part'
+        with h5py.File(partial_file, 'w', libver='latest') as hf:
+            for key, value in self.attrs.get('', {}).items():
+                hf.attrs[key] = value
+
+            hf.create_dataset('files', data=np.array([name.encode() for name in self.files]))
+            hf.create_dataset('iteration', data=np.array([_iteration_number(name) for name in self.files]))
+            signatures = [signature or (-1, -1.0) for signature in self.signatures]
+            hf.create_dataset('file_size', data=np.array([size for size, mtime in signatures], dtype=np.int64))
+            hf.create_dataset('file_mtime', data=np.array([mtime for size, mtime in signatures], dtype=np.float64))
+
+            hts = hf.create_group('timestamps')
+            for name, values in self.timestamps.items():
+                hts.create_dataset(name, data=np.array([value.encode() for value in values]))
+
+            for key, (shape, dtype, x0, dx) in sorted(self.datasets.items()):
+                group_name = key.split('/')[0]
+                if group_name not in hf:
+                    hg = hf.create_group(group_name)
+                    for attr, value in self.attrs.get(group_name, {}).items():
+                        hg.attrs[attr] = value
+
+                present = np.array(self.present[key], dtype=bool)
+                hf.create_dataset('present/' + key, data=present)
+
+                layout = h5py.VirtualLayout(shape=(len(self.files),) + tuple(shape), dtype=dtype)
+                for row in np.flatnonzero(present):
+                    # Source paths are relative to the index file, which sits next to the iteration files
+                    layout[row] = h5py.VirtualSource(self.files[row], key, shape=tuple(shape))
+
+                vdset = hf.create_virtual_dataset(key, layout, fillvalue=fillvalue)
+                vdset.attrs['x0'] = x0
+                vdset.attrs['dx'] = dx
+
+        os.replace(partial_file, filename)
+
+
+def _dataset_keys(group, prefix=''):
+    keys = []
+    for name, item in group.items():
+        if isinstance(item, h5py.Group):
+            keys.extend(_dataset_keys(item, prefix + name + '/'))
+        else:
+            keys.append(prefix + name)
+    return keys
+
+
+def update_vds(run_path, index_name=INDEX_NAME, rebuild=False):
+    # Creates or updates the VDS index of the iteration files in run_path. Returns the number of files added.
+    filename = path.join(run_path, index_name)
+
+    if path.exists(filename) and not rebuild:
+        index = RunIndex.load(filename)
+    else:
+        index = RunIndex()
+
+    known = {name: row for row, name in enumerate(index.files)}
+    signatures = {name: _signature(path.join(run_path, name)) for name in os.listdir(run_path)
+                  if fnmatch.fnmatch(name, FILE_PATTERN)}
+
+    # Files that changed since they were inventoried, most likely because they were still being written
+    updated = 0
+    for name, row in known.items():
+        if name in signatures and signatures[name] != index.signatures[row]:
+            try:
+                index.update(row, *inventory_file(path.join(run_path, name)), signature=signatures[name])
+                updated += 1
+            except (IOError, OSError) as e:
+                log('Skipping {}: {}'.format(name, e))
+
+    added = 0
+    for name in sorted((name for name in signatures if name not in known), key=_iteration_number):
+        try:
+            datasets, timestamps, attrs = inventory_file(path.join(run_path, name))
+        except (IOError, OSError) as e:
+            # Most likely still being written, pick it up on the next update
+            log('Skipping {}: {}'.format(name, e))
+            break
+
+        index.add(name, datasets, timestamps, attrs, signature=signatures[name])
+        added += 1
+
+    if added > 0 or updated > 0 or not path.exists(filename):
+        index.write(filename)
+
+    return added
+
+
+def _signature(filepath):
+    stat = os.stat(filepath)
+    return stat.st_size, stat.st_mtime
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build a virtual dataset index over the iteration files of a run.')
+    parser.add_argument('run_path', help='Directory with iteration_XXXXX.h5 files, e.g. <date>\\data\\<run>\\gagescope')
+    parser.add_argument('--rebuild', action='store_true', help='Rescan all files instead of updating')
+    parser.add_argument('--watch', type=float, default=None, help='Keep updating every WATCH seconds')
+    args = parser.parse_args()
+
+    added = update_vds(args.run_path, rebuild=args.rebuild)
+    print('Added {:d} iterations to {}'.format(added, path.join(args.run_path, INDEX_NAME)))
+
+    while args.watch is not None:
+        time.sleep(args.watch)
+        added = update_vds(args.run_path)
+        if added > 0:
+            print('Added {:d} iterations'.format(added))
@@ -0,0 +1,362 @@
+from __future__ import division, print_function
+import argparse
+import copy
+import fnmatch
+import importlib
+import os
+import re
+import sys
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from os import path
+
+from qtpy import QtCore, QtGui, QtWidgets
+import numpy as np
+import h5py
+
+import sigfile
+from gage_preview import PREVIEW_GROUP
+from gage_util import ChannelConfig, DecimateFilter, GageMode, log
+from gage_widgets import ChannelWidget
+
+# Offline viewer for saved iteration_XXXXX.h5 and AS_CHxx-NNNNN.sig files. Files are loaded, scaled and passed
+# through the display filter of their channel on a thread pool, for the shown file and its prefetch neighbours,
+# and the filtered traces are kept in an LRU cache bounded by memory.
+
+FILE_PATTERNS = ('iteration_*.h5', 'AS_CH??-*.sig')
+
+
+def list_files(directory):
+    names = [name for name in os.listdir(directory) if any(fnmatch.fnmatch(name, p) for p in FILE_PATTERNS)]
+    return [path.join(directory, name) for name in sorted(names)]
+
+
+def _scale(raw, input_range, sample_res, sample_offset, dc_offset=0.0):
+    # Same scaling as GageCapture.prepare_plot
+    return np.double(sample_offset - raw) / sample_res * input_range / 2000.0 + dc_offset
+
+
+def _decode(value):
+    return value.decode() if isinstance(value, bytes) else str(value)
+
+
+def _trigger_lines(hf):
+    # {prefix: line} in trigger order. Older files without the prefixes attribute are ordered by their timestamps.
+    if 'prefixes' in hf.attrs:
+        return {_decode(prefix): line for line, prefix in enumerate(hf.attrs['prefixes'])}
+
+    timestamps = {key[:-len('timestamp')].rstrip('_'): _decode(value) for key, value in hf.attrs.items()
+                  if key.endswith('timestamp')}
+    return {prefix: line for line, prefix in enumerate(sorted(timestamps, key=timestamps.get))}
+
+
+def _dataset_line(dataset_name, dset, lines):
+    if 'trigger' in dset.attrs:
+        return int(dset.attrs['trigger'])
+
+    # Longest matching prefix, prefixes and segment names can contain '_' themselves
+    for prefix in sorted(lines, key=len, reverse=True):
+        if prefix and dataset_name.startswith(prefix + '_'):
+            return lines[prefix]
+    return lines.get('', 0)
+
+
+def read_traces(filepath):
+    # Returns {cid: [(line, name, sample_rate, t, volts)]}, one line per trigger step of an iteration file
+    traces = {}
+
+    if filepath.endswith('.sig'):
+        match = re.search(r'AS_CH(\d+)-\d+\.sig$', filepath)
+        cid = int(match.group(1)) if match else 1
+        with sigfile.open_sig(filepath) as sig:
+            traces[cid] = [(0, None, sig.sample_rate, sig.time(), sig.volts())]
+        return traces
+
+    with h5py.File(filepath, 'r') as hf:
+        trigger_lines = _trigger_lines(hf)
+
+        for group_name, hg in hf.items():
+            if not isinstance(hg, h5py.Group) or group_name == PREVIEW_GROUP:
+                continue
+            cid = int(group_name[2:])
+            name = hg.attrs.get('name')
+
+            # All segments of a trigger step go into one line
+            lines = {}
+            for dataset_name, dset in hg.items():
+                line = _dataset_line(dataset_name, dset, trigger_lines)
+                x0, dx = dset.attrs.get('x0', 0.0), dset.attrs.get('dx', 1.0)
+                lines.setdefault(line, []).append((x0, dx, dset[:]))
+
+            traces[cid] = []
+            for line, segments in sorted(lines.items()):
+                segments.sort(key=lambda segment: segment[0])
+                dx = segments[0][1]
+                t = np.concatenate([x0 + dx * np.arange(len(raw)) for x0, dx, raw in segments])
+                raw = np.concatenate([raw for x0, dx, raw in segments])
+                volts = _scale(raw, hg.attrs['input_range'], hg.attrs['sample_res'], hg.attrs['sample_offset'],
+                               hg.attrs.get('dc_offset', 0.0))
+                traces[cid].append((line, name, 1.0 / dx, t, volts))
+
+    return traces
+
+
+class TraceCache(object):
+    # LRU cache of filtered traces, bounded by the total size of the cached arrays
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+            return self._entries[key][0]
+
+    def put(self, key, value, nbytes):
+        with self._lock:
+            if key in self._entries:
+                self.nbytes -= self._entries.pop(key)[1]
+            self._entries[key] = (value, nbytes)
+            self.nbytes += nbytes
+
+            while self.nbytes > self.max_bytes and len(self._entries) > 1:
+                _, (_, size) = self._entries.popitem(last=False)
+                self.nbytes -= size
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+
+class GageViewer(QtWidgets.QMainWindow):
+    file_loaded = QtCore.Signal(str)
+
+    def __init__(self, channel_config=None, prefetch=4, workers=4, cache_mb=1024, parent=None):
+        super(GageViewer, self).__init__(parent)
+
+        # Channels without a configuration get a decimating display filter
+        self.channel_config = {config.id: config for config in (channel_config or [])}
+        self.default_filter = DecimateFilter(1, max_length=200e3)
+        self.prefetch = prefetch
+
+        self.files = []
+        self.index = -1
+
+        self.cache = TraceCache(cache_mb * 1024 * 1024)
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._pending = {}  # filepath -> Future
+        self._local = threading.local()
+
+        self.file_loaded.connect(self._on_file_loaded)
+
+        self.setupUi()
+
+    def setupUi(self):
+        self.setWindowTitle("Gage Viewer")
+        self.centralWidget = QtWidgets.QWidget()
+        self.setCentralWidget(self.centralWidget)
+        self.resize(1280, 768)
+
+        self.file_list = QtWidgets.QListWidget()
+        self.file_list.setFixedWidth(250)
+        self.file_list.currentRowChanged.connect(self.show_file)
+
+        open_button = QtWidgets.QPushButton('Open Directory...')
+        open_button.clicked.connect(self.menu_open)
+        prev_button = QtWidgets.QPushButton('< Previous')
+        prev_button.clicked.connect(lambda: self.step(-1))
+        next_button = QtWidgets.QPushButton('Next >')
+        next_button.clicked.connect(lambda: self.step(1))
+
+        QtWidgets.QShortcut(QtGui.QKeySequence(QtCore.Qt.Key_Left), self, lambda: self.step(-1))
+        QtWidgets.QShortcut(QtGui.QKeySequence(QtCore.Qt.Key_Right), self, lambda: self.step(1))
+
+        button_layout = QtWidgets.QHBoxLayout()
+        button_layout.addWidget(open_button)
+        button_layout.addWidget(prev_button)
+        button_layout.addWidget(next_button)
+
+        self.channel_layout = QtWidgets.QVBoxLayout()
+        self.channel_widgets = {}
+
+        plot_layout = QtWidgets.QVBoxLayout()
+        plot_layout.addLayout(button_layout)
+        plot_layout.addLayout(self.channel_layout)
+
+        layout = QtWidgets.QHBoxLayout()
+        layout.addWidget(self.file_list)
+        layout.addLayout(plot_layout)
+
+        self.centralWidget.setLayout(layout)
+
+    def closeEvent(self, event):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def menu_open(self):
+        directory = QtWidgets.QFileDialog.getExistingDirectory(self, 'Open run directory')
+        if directory:
+            self.open_directory(directory)
+
+    def open_directory(self, directory):
+        for future in self._pending.values():
+            future.cancel()
+        self._pending = {}
+        self.cache.clear()
+
+        self.files = list_files(directory)
+        self.setWindowTitle('Gage Viewer - {}'.format(directory))
+
+        self.file_list.clear()
+        self.file_list.addItems([path.basename(filepath) for filepath in self.files])
+        if len(self.files) > 0:
+            self.file_list.setCurrentRow(0)
+
+    def step(self, offset):
+        index = self.index + offset
+        if 0 <= index < len(self.files):
+            self.file_list.setCurrentRow(index)
+
+    def get_config(self, cid, name=None):
+        if cid not in self.channel_config:
+            self.channel_config[cid] = ChannelConfig(cid, None, None, None, name=name, filter=self.default_filter)
+        return self.channel_config[cid]
+
+    def show_file(self, index):
+        if not 0 <= index < len(self.files):
+            return
+        self.index = index
+
+        filepath = self.files[index]
+        traces = self.cache.get(filepath)
+        if traces is not None:
+            self._plot(traces)
+        else:
+            self.statusBar().showMessage('Loading {}...'.format(path.basename(filepath)))
+            self._submit(filepath)
+
+        self._prefetch(index)
+
+    def _prefetch(self, index):
+        # Load the neighbouring files, nearest first, and drop queued loads that are out of the window
+        window = [self.files[idx] for offset in range(1, self.prefetch + 1) for idx in (index + offset, index - offset)
+                  if 0 <= idx < len(self.files)]
+
+        for filepath, future in list(self._pending.items()):
+            if filepath != self.files[index] and filepath not in window and future.cancel():
+                del self._pending[filepath]
+
+        for filepath in window:
+            if filepath not in self.cache:
+                self._submit(filepath)
+
+    def _submit(self, filepath):
+        if filepath not in self._pending:
+            self._pending[filepath] = self._executor.submit(self._load, filepath)
+
+    def _filter(self, cid):
+        # Display filters keep state between traces (SpectrumFilter, PeakIntegralFilter), every pool thread gets
+        # its own copies
+        filters = self._local.__dict__.setdefault('filters', {})
+        if cid not in filters:
+            config = self.channel_config.get(cid)
+            filters[cid] = copy.deepcopy(config.filter if config is not None else self.default_filter)
+        return filters[cid]
+
+    def _load(self, filepath):
+        # Runs on the thread pool. file_loaded is emitted in any case, the file is in the cache if it succeeded.
+        try:
+            traces = read_traces(filepath)
+
+            # Configurations of new channels are only created on the UI thread, in _plot
+            filtered = {}
+            nbytes = 0
+            for cid, lines in traces.items():
+                display_filter = self._filter(cid)
+
+                filtered[cid] = []
+                for line, name, sample_rate, t, volts in lines:
+                    filt_time, filt_data = display_filter.for_line(line).apply(sample_rate, t, volts)
+                    filt_time, filt_data = np.asarray(filt_time), np.asarray(filt_data)
+                    filtered[cid].append((line, name, filt_time, filt_data))
+                    nbytes += filt_time.nbytes + filt_data.nbytes
+
+            self.cache.put(filepath, filtered, nbytes)
+        except Exception as e:
+            log('Could not load {}: {}'.format(filepath, e))
+        finally:
+            self.file_loaded.emit(filepath)
+
+    def _on_file_loaded(self, filepath):
+        self._pending.pop(filepath, None)
+        if 0 <= self.index < len(self.files) and filepath == self.files[self.index]:
+            traces = self.cache.get(filepath)
+            if traces is not None:
+                self._plot(traces)
+            else:
+                self.statusBar().showMessage('Could not load {}'.format(path.basename(filepath)))
+
+    def _plot(self, traces):
+        for cid, lines in sorted(traces.items()):
+            widget = self.channel_widgets.get(cid)
+            if widget is None:
+                widget = ChannelWidget(self.get_config(cid, lines[0][1] if lines else None))
+                widget.on_mode_changed(GageMode.TRAD)  # Hides the segment table
+                self.channel_layout.addWidget(widget)
+                self.channel_widgets[cid] = widget
+
+            num_lines = max(line for line, name, t, data in lines) + 1 if lines else 1
+            if num_lines != len(widget.lines):
+                widget.set_triggers([None] * num_lines)
+
+            for idx in widget.lines:
+                widget.plot([], [], line=idx)
+            for line, name, t, data in lines:
+                widget.plot(t, data, line=line)
+
+        self.statusBar().showMessage('{} ({:d} of {:d}), cache {:.0f} MB'.format(
+            path.basename(self.files[self.index]), self.index + 1, len(self.files), self.cache.nbytes / 1024 ** 2))
+
+
+def load_channel_config(module_name):
+    # channel_config of a configuration module (gage_channels), with the display filters of its channels
+    try:
+        module = importlib.import_module(module_name)
+        return list(module.channel_config)
+    except Exception as e:
+        log('Could not load the channel configuration of {}: {}'.format(module_name, e))
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Browse saved iteration_*.h5 and AS_CH*.sig files.')
+    parser.add_argument('directory', nargs='?', default=None)
+    parser.add_argument('--prefetch', type=int, default=4, help='Files to load ahead on each side')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--cache', type=int, default=1024, help='Trace cache size in MB')
+    parser.add_argument('--config', default='gage_channels',
+                        help='Module to take the channel configuration from (none for decimation only)')
+    args = parser.parse_args()
+
+    app = QtWidgets.QApplication(sys.argv[:1])
+    channel_config = load_channel_config(args.config) if args.config != 'none' else None
+    viewer = GageViewer(channel_config, prefetch=args.prefetch, workers=args.workers, cache_mb=args.cache)
+    viewer.show()
+    if args.directory is not None:
+        viewer.open_directory(args.directory)
+    sys.exit(app.exec_())
+
+
+if __name__ == '__main__':
+    main()
@@ -6,8 +6,10 @@ from os import makedirs, path
 
 from qtpy import QtCore, QtGui, QtWidgets
 
+import numpy as np
 import pyqtgraph as pg
-from gage_util import GageMode,GageState
+import gage_trace as trace
+from gage_util import GageMode,GageState,RingBuffer,TraceHistogram,count_dtype,minmax_pyramid
 
 def SlotHandler(func):
 	@wraps(func)
@@ -21,6 +23,9 @@ def SlotHandler(func):
 		
 class ChannelWidget(QtWidgets.QWidget):
 	
+	# Traces longer than twice this are drawn min/max decimated to the visible x-range
+	LOD_MIN_POINTS = 2000
+	
 	def __init__(self, config, plot_config = None, segments=[], parent=None):
 		super(ChannelWidget, self).__init__(parent)
 		
@@ -29,6 +34,19 @@ class ChannelWidget(QtWidgets.QWidget):
 
 		self.lines = {}
 		self.segment_region = {}
+		
+		# Full resolution data of each line, and its cached min/max levels, for level-of-detail drawing
+		self.traces = {}
+		self._updating = False
+		
+		# Persistence histogram of all traces added with add_persistence, drawn as an image behind the lines with
+		# the next plot
+		self.histogram = None
+		self.image = None
+		self._image_stale = False
+		
+		# Running average of each line: (mean, mean + std, mean - std, band between them)
+		self.average_lines = {}
 			
 		self.setupUi(segments)
 		
@@ -36,11 +54,15 @@ class ChannelWidget(QtWidgets.QWidget):
 		self._pw = pg.PlotWidget()
 						
 		plot_item = self._pw.getPlotItem()
-		plot_item.setLabel('bottom', text='Time', units='s')
-		plot_item.setLabel('left', text='Signal', units='V')
+		display_filter = self.config.filter
+		plot_item.setLabel('bottom', text=display_filter.x_label[0], units=display_filter.x_label[1])
+		plot_item.setLabel('left', text=display_filter.y_label[0], units=display_filter.y_label[1])
+		plot_item.setLogMode(y=display_filter.log_y)
+		plot_item.getViewBox().sigXRangeChanged.connect(self._update_view)
 		
 		self._leg = None
 		self._update_lines(1)
+		self.set_persistence(self.config.persistence)
 		
 		self.segment_widget = SegmentWidget(self.config, segments)
 		self.segment_widget.table.changed.connect(self._update_segments)
@@ -48,8 +70,23 @@ class ChannelWidget(QtWidgets.QWidget):
 		if segments is not None:
 			self._update_segments(segments)
 		
+		self.shots_check = QtWidgets.QCheckBox('Last shot')
+		self.shots_check.setChecked(True)
+		self.shots_check.toggled.connect(self._show_shots)
+		self.average_check = QtWidgets.QCheckBox('Average')
+		self.average_check.toggled.connect(self._show_averages)
+		
+		options_layout = QtWidgets.QHBoxLayout()
+		options_layout.addWidget(self.shots_check)
+		options_layout.addWidget(self.average_check)
+		options_layout.addStretch()
+		
+		plot_layout = QtWidgets.QVBoxLayout()
+		plot_layout.addWidget(self._pw)
+		plot_layout.addLayout(options_layout)
+		
 		layout = QtWidgets.QHBoxLayout()
-		layout.addWidget(self._pw)
+		layout.addLayout(plot_layout)
 		layout.addWidget(self.segment_widget)
 		
 		self.setLayout(layout)
@@ -60,10 +97,14 @@ class ChannelWidget(QtWidgets.QWidget):
 			for idx,region in self.segment_region.items():
 				region.setVisible(False)
 			self._update_lines(1)
+			# Running averages are only kept in SEG mode
+			self.average_check.setChecked(False)
+			self.average_check.setVisible(False)
 		else:
 			self.segment_widget.setVisible(True)
 			for idx,region in self.segment_region.items():
 				region.setVisible(True)
+			self.average_check.setVisible(True)
 			
 	def on_state_changed(self, mode):
 		if mode == GageState.IDLE:
@@ -85,12 +126,15 @@ class ChannelWidget(QtWidgets.QWidget):
 		
 		if num > len(self.lines):
 			for idx in range(len(self.lines), num):
-				self.lines[idx] = pg.PlotDataItem(pen=self.config.get_pen(idx))
+				self.lines[idx] = TraceDataItem(pen=self.config.get_pen(idx))
 				plot_item.addItem(self.lines[idx])
 		elif num < len(self.lines):
 			for idx in range(num, len(self.lines)):
 				plot_item.removeItem(self.lines[idx])
 				del self.lines[idx]
+				self.traces.pop(idx, None)
+				for item in self.average_lines.pop(idx, ()):
+					plot_item.removeItem(item)
 
 		# Remove and recreate legend. Adding and removing items in legend is too buggy in pyqtgraph-0.10.0
 		if self._leg is not None:
@@ -124,8 +168,304 @@ class ChannelWidget(QtWidgets.QWidget):
 				plot_item.removeItem(self.segment_region[idx])
 				del self.segment_region[idx]
 
+	def set_persistence(self, options):
+		# options: TraceHistogram arguments, None to switch persistence off
+		plot_item = self._pw.getPlotItem()
+		if self.image is not None:
+			plot_item.removeItem(self.image)
+			self.image = None
+		
+		self._persistence = options
+		if options is None:
+			self.histogram = None
+			return
+		
+		self.histogram = TraceHistogram(**options)
+		self.image = pg.ImageItem()
+		self.image.setZValue(-10)
+		plot_item.addItem(self.image)
+	
+	def clear_persistence(self):
+		# Starts over, including the ranges if they were taken from the first trace
+		if self.histogram is not None:
+			self.histogram = TraceHistogram(**self._persistence)
+			self.image.clear()
+			self._image_stale = False
+	
+	def add_persistence(self, t, data):
+		if self.histogram is not None:
+			self.histogram.add(t, data)
+			self._image_stale = True
+	
+	def _update_image(self):
+		self._image_stale = False
+		histogram = self.histogram
+		x0, x1 = histogram.x_range
+		y0, y1 = histogram.y_range
+		
+		self.image.setImage(np.log1p(histogram.counts.astype(np.float32)), autoLevels=True)
+		self.image.setRect(QtCore.QRectF(x0, y0, x1 - x0, y1 - y0))
+	
 	def plot(self, t, data, line=0):
-		self.lines[line].setData(t, data)
+		t = np.asarray(t)
+		data = np.asarray(data)
+		
+		if self._image_stale and self.histogram is not None:
+			self._update_image()
+		
+		# Only long traces with sorted time axis are drawn decimated to the visible range, auto-range still fits
+		# the full trace
+		if len(t) > 2 * self.LOD_MIN_POINTS and np.all(t[1:] >= t[:-1]):
+			self.traces[line] = (t, data, {})
+			self.lines[line].set_full_bounds(t, data)
+			self._update_line(line)
+		else:
+			self.traces.pop(line, None)
+			self.lines[line].set_full_bounds(None, None)
+			self.lines[line].setData(t, data)
+	
+	def plot_average(self, t, mean, std, line=0):
+		if line not in self.average_lines:
+			plot_item = self._pw.getPlotItem()
+			
+			pen = QtGui.QPen(self.config.get_pen(line))
+			pen.setWidth(2)
+			pen.setStyle(QtCore.Qt.DashLine)
+			color = pen.color()
+			color.setAlpha(60)
+			
+			mean_item = pg.PlotDataItem(pen=pen)
+			upper = pg.PlotDataItem(pen=None)
+			lower = pg.PlotDataItem(pen=None)
+			band = pg.FillBetweenItem(upper, lower, brush=pg.mkBrush(color))
+			self.average_lines[line] = (mean_item, upper, lower, band)
+			
+			for item in self.average_lines[line]:
+				item.setVisible(self.average_check.isChecked())
+				plot_item.addItem(item)
+		
+		mean_item, upper, lower, band = self.average_lines[line]
+		mean_item.setData(t, mean)
+		upper.setData(t, mean + std)
+		lower.setData(t, mean - std)
+	
+	def _show_shots(self, checked):
+		for item in self.lines.values():
+			item.setVisible(checked)
+	
+	def _show_averages(self, checked):
+		for items in self.average_lines.values():
+			for item in items:
+				item.setVisible(checked)
+	
+	def _levels(self, line):
+		# Min/max pyramid of the full trace at power of 2 factors, computed once per trace
+		t, data, levels = self.traces[line]
+		if not levels:
+			factors = [2 ** k for k in range(1, max(2, int(np.log2(len(data)))))]
+			levels.update(minmax_pyramid(data, factors))
+		return levels
+	
+	def _update_line(self, line):
+		t, data, levels = self.traces[line]
+		view_box = self._pw.getPlotItem().getViewBox()
+		
+		x_min, x_max = view_box.viewRange()[0]
+		pixels = max(int(view_box.width()), 100)
+		
+		# One sample margin on either side, so the line continues to the edges of the view
+		start = max(np.searchsorted(t, x_min, side='right') - 1, 0)
+		stop = min(np.searchsorted(t, x_max, side='left') + 1, len(t))
+		
+		# Coarsest level that leaves at least one min/max pair per pixel, i.e. about 2 points per pixel
+		factor = 1
+		for level in sorted(self._levels(line)):
+			if (stop - start) / level >= pixels:
+				factor = level
+		
+		if factor == 1:
+			self.lines[line].setData(t[start:stop], data[start:stop])
+			return
+		
+		bins = self._levels(line)[factor][start // factor:-(-stop // factor)]
+		bin_t = t[(np.arange(start // factor, start // factor + len(bins)) * factor)]
+		self.lines[line].setData(np.repeat(bin_t, 2), bins.ravel())
+	
+	def _update_view(self, *args):
+		# Redraw the decimated lines for the new visible x-range. Guarded, as setData can trigger a range change.
+		if self._updating:
+			return
+		
+		self._updating = True
+		try:
+			for line in self.traces:
+				self._update_line(line)
+		finally:
+			self._updating = False
+
+
+class CountRateWidget(QtWidgets.QWidget):
+	# Strip chart of the photon counts per capture and segment over the last span seconds, one line per
+	# (channel, trigger, segment). Counts are kept in a ring buffer and redrawn at most max_fps times per second.
+	# Captures flagged as saturated are marked in red.
+	
+	def __init__(self, size=20000, span=300.0, max_fps=5, parent=None):
+		super(CountRateWidget, self).__init__(parent)
+		
+		self.buffer = RingBuffer(size, count_dtype())
+		self.span = span
+		self.lines = {}
+		self._dirty = False
+		
+		self.setupUi()
+		
+		self.timer = QtCore.QTimer(self)
+		self.timer.timeout.connect(self.redraw)
+		self.timer.start(int(round(1000 / max_fps)))
+	
+	def setupUi(self):
+		self._pw = pg.PlotWidget()
+		plot_item = self._pw.getPlotItem()
+		plot_item.setLabel('bottom', text='Time', units='s')
+		plot_item.setLabel('left', text='Photons')
+		self._leg = plot_item.addLegend(offset=(-20, 20))
+		
+		self.saturated = pg.ScatterPlotItem(pen=None, brush=pg.mkBrush('r'), size=6)
+		plot_item.addItem(self.saturated)
+		
+		self.clear_button = QtWidgets.QPushButton('Clear')
+		self.clear_button.clicked.connect(self.clear)
+		
+		layout = QtWidgets.QVBoxLayout()
+		layout.addWidget(self._pw)
+		layout.addWidget(self.clear_button)
+		self.setLayout(layout)
+	
+	def add_counts(self, counts):
+		for row in counts:
+			self.buffer.append(row)
+		self._dirty = True
+	
+	def clear(self):
+		self.buffer.clear()
+		self._dirty = True
+	
+	def redraw(self):
+		if not self._dirty:
+			return
+		self._dirty = False
+		
+		values = self.buffer.values()
+		now = QtCore.QDateTime.currentMSecsSinceEpoch() / 1000.0
+		values = values[values['timestamp'] > now - self.span]
+		t = values['timestamp'] - now
+		
+		keys = np.stack((values['channel'], values['trigger']), axis=1) if len(values) > 0 else np.zeros((0, 2))
+		shown = set()
+		for channel, trigger, segment in set(zip(values['channel'], values['trigger'], values['segment'])):
+			key = (int(channel), int(trigger), segment)
+			mask = (keys[:, 0] == channel) & (keys[:, 1] == trigger) & (values['segment'] == segment)
+			
+			if key not in self.lines:
+				name = 'CH{:d} {:d} {}'.format(key[0], key[1], segment.decode())
+				self.lines[key] = pg.PlotDataItem(pen=pg.intColor(len(self.lines)), name=name)
+				self._pw.getPlotItem().addItem(self.lines[key])
+			self.lines[key].setData(t[mask], values['count'][mask])
+			shown.add(key)
+		
+		for key, line in self.lines.items():
+			if key not in shown:
+				line.setData([], [])
+		
+		saturated = values['saturated']
+		self.saturated.setData(t[saturated], values['count'][saturated])
+
+
+class TraceDataItem(pg.PlotDataItem):
+	# PlotDataItem that shows only the visible part of a longer trace, with the data bounds of the full trace so
+	# auto-range is not limited to the part shown
+	
+	def __init__(self, *args, **kwargs):
+		super(TraceDataItem, self).__init__(*args, **kwargs)
+		self.full_bounds = None
+	
+	def set_full_bounds(self, t, data):
+		if t is None:
+			self.full_bounds = None
+			return
+		finite = data[np.isfinite(data)]
+		if len(finite) == 0:
+			self.full_bounds = None
+			return
+		# x, y, and y in the log10 coordinates of a log-y view
+		positive = finite[finite > 0]
+		log_bounds = (np.log10(positive.min()), np.log10(positive.max())) if len(positive) > 0 else (None, None)
+		self.full_bounds = ((t[0], t[-1]), (finite.min(), finite.max()), log_bounds)
+	
+	def dataBounds(self, ax, frac=1.0, orthoRange=None):
+		if self.full_bounds is None:
+			return super(TraceDataItem, self).dataBounds(ax, frac, orthoRange)
+		if ax == 1 and self.opts['logMode'][1]:
+			return self.full_bounds[2]
+		return self.full_bounds[ax]
+
+
+class PlotScheduler(QtCore.QObject):
+	# Keeps only the latest plot data per (channel, line) and repaints at most max_fps times per second, so the
+	# UI load does not grow with the trigger rate. Frames replaced before they were drawn are counted as coalesced.
+	
+	def __init__(self, channel_widgets, max_fps=20, parent=None):
+		super(PlotScheduler, self).__init__(parent)
+		
+		self.channel_widgets = channel_widgets
+		self.pending = {}
+		
+		self.frames = 0
+		self.coalesced = 0
+		
+		self.timer = QtCore.QTimer(self)
+		self.timer.timeout.connect(self.repaint)
+		self.set_max_fps(max_fps)
+		
+	def set_max_fps(self, max_fps):
+		self.timer.start(int(round(1000 / max_fps)))
+		
+	def submit(self, plot_data, line=0, average=False, capture=None):
+		# plot_data: {cid: (t, data)}, or {cid: (t, mean, std)} for running averages. The capture, if given, is
+		# stamped once it has been drawn. Every trace goes into the persistence histograms, also if it is coalesced.
+		for cid, values in plot_data.items():
+			if cid not in self.channel_widgets:
+				continue
+			if not average:
+				self.channel_widgets[cid].add_persistence(*values)
+			if (cid, line, average) in self.pending:
+				self.coalesced += 1
+			self.pending[(cid, line, average)] = (values, capture)
+			
+	@trace.traced('PlotScheduler.repaint')
+	def repaint(self):
+		if len(self.pending) == 0:
+			return
+		
+		pending, self.pending = self.pending, {}
+		captures = set()
+		for (cid, line, average), (values, capture) in pending.items():
+			if average:
+				self.channel_widgets[cid].plot_average(*values, line=line)
+			else:
+				self.channel_widgets[cid].plot(*values, line=line)
+			if capture is not None:
+				captures.add(capture)
+		self.frames += len(pending)
+		
+		for capture in captures:
+			capture.stamp('plot')
+		
+	def stats(self):
+		# Returns (frames drawn, frames coalesced) since the last call
+		frames, coalesced = self.frames, self.coalesced
+		self.frames = self.coalesced = 0
+		return frames, coalesced
 
 
 class SegmentWidget(QtWidgets.QWidget):
@@ -424,9 +764,10 @@ class RunWidget(QtWidgets.QWidget):
 	status = QtCore.Signal(bool)
 	incremented = QtCore.Signal(int)
 	
-	def __init__(self, data_root, analysis_root=None, mode=GageMode.TRAD, parent=None):
+	def __init__(self, data_root, analysis_root=None, mode=GageMode.TRAD, spool_root=None, parent=None):
 		super(RunWidget, self).__init__(parent)
 		self.data_root = data_root
+		self.spool_root = spool_root # If set, files are written here first, and moved to data_root in the background
 		self.analysis_root = analysis_root
 		self.mode = mode
 		
@@ -454,6 +795,9 @@ class RunWidget(QtWidgets.QWidget):
 
 		layout.addWidget(QtWidgets.QLabel('Data root:'))
 		layout.addWidget(QtWidgets.QLabel(self.data_root))
+		if self.spool_root:
+			layout.addWidget(QtWidgets.QLabel('Spool:'))
+			layout.addWidget(QtWidgets.QLabel(self.spool_root))
 		layout.addWidget(QtWidgets.QLabel('Date:'))
 		layout.addWidget(self.run_date)
 		layout.addWidget(QtWidgets.QLabel('Run name:'))
@@ -503,7 +847,12 @@ class RunWidget(QtWidgets.QWidget):
 				if not path.exists(analysisPath):
 					makedirs(analysisPath)
 			
-			if path.exists(path.join(targetPath, filename)):
+			# When spooling, the file may already be moved to the data root
+			exists = path.exists(path.join(targetPath, filename))
+			if self.spool_root:
+				exists = exists or path.exists(path.join(self.data_root, path.relpath(targetPath, self.spool_root), filename))
+			
+			if exists:
 			
 				msg = "The target file already exists, overwrite?"
 				reply = QtWidgets.QMessageBox.question(self, 'Overwrite confirmation', 
@@ -543,11 +892,14 @@ class RunWidget(QtWidgets.QWidget):
 	def getRunname(self):
 		return self.run_name.text()
 		
+	def getWriteRoot(self):
+		return self.spool_root if self.spool_root else self.data_root
+	
 	def getTarget(self, channel=1):
 		date = self.run_date.text()
 		runname = self.run_name.text()
 		runPath = "{runname:s}_CH{channel:02d}".format(runname=runname, channel=channel)
-		targetPath = path.join(self.data_root, str(date), runPath, 'Folder.00001')
+		targetPath = path.join(self.getWriteRoot(), str(date), runPath, 'Folder.00001')
 		filename = 'AS_CH{channel:02d}-{file:05d}.sig'.format(channel=channel, file=self.cur_file)
 		
 		return filename, targetPath
@@ -556,12 +908,23 @@ class RunWidget(QtWidgets.QWidget):
 		date = self.run_date.text()
 		runname = self.run_name.text()
 		runPath = "{runname:s}".format(runname=runname)
-		targetPath = path.join(self.data_root, str(date), 'data', runPath, 'gagescope')
+		targetPath = path.join(self.getWriteRoot(), str(date), 'data', runPath, 'gagescope')
 	
 		filename = 'iteration_{file:05d}.h5'.format(file=self.cur_file)
 		
 		return filename, targetPath
 
+	def getTargetStore(self, iterations=None):
+		# Run-level store next to the per-iteration files. Split into blocks if iterations per file is given.
+		filename, targetPath = self.getTargetH5()
+		
+		if iterations is None:
+			filename = 'iterations.h5'
+		else:
+			filename = 'iterations_{block:05d}.h5'.format(block=self.cur_file // iterations)
+		
+		return filename, targetPath
+
 	def update_text(self):
 		filename, targetPath = self.getTargetH5()
 		self.file_label.setText(f'Next File Name: {path.join(targetPath, filename)}')
\ No newline at end of file
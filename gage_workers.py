@@ -3,22 +3,35 @@ import csapi
 import math
 import datetime
 import os
+import shutil
+import sqlite3
+import time
+from functools import partial
 from os import path
 
 from qtpy import QtCore
 import numpy as np
 import h5py
 
-from gage_util import e3decimate, log
+from gage_util import RunningAverage, count_dtype, e3decimate, get_field_name, log
+import sigfile
+from gage_store import GageRunStore
+from gage_catalog import entries_from_capture, entries_from_iteration
+from gage_preview import PREVIEW_GROUP, sidecar_name, write_pyramid, write_sidecar
+import gage_trace as trace
 
 
 class GageCapture(object):
 
-    def __init__(self, channel_config, timestamp):
+    def __init__(self, channel_config, timestamp, timer=None):
 
         self.channel_config = {cfg.id: cfg for cfg in channel_config}  # Reindex as dict
         self.timestamp = timestamp
 
+        # perf_counter_ns() stamps of the pipeline stages (see gage_timing), recorded by timer if given
+        self.timer = timer
+        self.stamps = {}
+
         self.channels = {}
         self.data = {}
         self.channel_rate = {}
@@ -27,9 +40,17 @@ class GageCapture(object):
         self.acquisition = None
         self.trigger = None
 
+        self.photon_counts = None
+        self.sequence = None  # Number of the acquisition callback, including dropped captures
+
     def __del__(self):
         log('GageCapture Deleted', 7)
 
+    def stamp(self, stage, value=None):
+        self.stamps[stage] = time.perf_counter_ns() if value is None else value
+        if self.timer is not None:
+            self.timer.record(stage, self.stamps)
+
     def download(self, gage):
         self.info = gage.GetInfo()
         self.acquisition = gage.GetAcquisition(csapi.Config.ACQUISITION)
@@ -38,7 +59,8 @@ class GageCapture(object):
         for cid, config in self.channel_config.items():
             self.channels[cid] = gage.GetChannel(channel=cid, config=csapi.Config.ACQUISITION)
             self.channel_rate[cid] = self.acquisition.sample_rate
-            self.data[cid] = gage.Download(cid, self.acquisition.segment_size)
+            with trace.span('Download'):
+                self.data[cid] = gage.Download(cid, self.acquisition.segment_size)
 
     def resample(self):
         for cid, config in self.channel_config.items():
@@ -52,7 +74,7 @@ class GageCapture(object):
                 self.channel_rate[cid] = sample_rate / resample_dec
 
     # noinspection PyPep8Naming
-    def prepare_plot(self):
+    def prepare_plot(self, line=0):
 
         plot_data = {}
 
@@ -64,29 +86,58 @@ class GageCapture(object):
             scaled_data = np.double(sample_offset - self.data[cid]) / resolution * range_mVpp / 2000.0 + offset_V
 
             t = np.arange(len(scaled_data), dtype=np.double) / self.channel_rate[cid]
-            filt_time, filt_data = config.filter.apply(self.channel_rate[cid], t, scaled_data)
+            filt_time, filt_data = config.filter.for_line(line).apply(self.channel_rate[cid], t, scaled_data)
             plot_data[cid] = (filt_time, filt_data) #plotting the filterred data
 
         return plot_data
 
+    def count_photons(self, trigger=0):
+        # Photon counts per segment of the channels with a peak counting filter (PeakIntegralFilter), from the last
+        # prepare_plot. Channels without segments are counted over the whole record.
+        rows = []
+        for cid, config in self.channel_config.items():
+            peak_times = getattr(config.filter, 'peak_times', None)
+            if peak_times is None:
+                continue
+
+            segments = config.segments if len(config.segments) > 0 else [('total', 0.0, np.inf)]
+            for name, start, stop in segments:  # start, stop in ms
+                count = np.searchsorted(peak_times, stop / 1e3) - np.searchsorted(peak_times, start / 1e3)
+                rows.append((0, self.timestamp.timestamp(), trigger, cid, name.encode(), count,
+                             config.filter.saturated))
+
+        self.photon_counts = np.array(rows, dtype=count_dtype())
+        return self.photon_counts
+
+    def get_segments(self, cid):
+        # Returns a list of (name, x0, dx, data) tuples for the configured segments of a channel
+        segments = []
+        dx = 1.0 / self.channel_rate[cid]
+
+        for name, start, stop in self.channel_config[cid].segments:  # start, stop in ms
+            imin = int(math.floor(start / 1e3 / dx))
+            imax = int(math.ceil(stop / 1e3 / dx))
+            segments.append((name, imin * dx, dx, self.data[cid][imin:imax]))
+
+        return segments
+
+    def save_channel_preview(self, filename, cid):
+        # Min/max preview pyramid of a .sig file, in a sidecar file next to it
+        write_sidecar(filename, self.data[cid], 0.0, 1.0 / self.channel_rate[cid], self.channel_config[cid].preview)
+
     # noinspection PyTypeChecker
+    @trace.traced('save_channel_sig')
     def save_channel_sig(self, filename, cid):
 
         pack_date, pack_time = self.pack_timestamp(self.timestamp)
 
-        gain_range = (20, 10, 4, 2, 1, .4, .2)
-        sample_rates = (1.0, 2.0, 5.0, 10.0, 20.0, 50.0, 100.0, 200.0, 500.0, 1e3, 2e3, 5e3, 1e4, 2e4, 5e4, 1e5,
-                        2e5, 5e5, 1e6, 2e6, 2.5e6, 5e6, 1e7, 1.25e7, 2e7, 2.5e7, 3e7, 4e7, 5e7, 6e7, 6.5e7, 8e7,
-                        1e8, 1.2e8, 1.25e8, 1.3e8, 1.5e8, 2e8, 2.5e8, 3e8, 5e8, 1e9, 2e9, 4e9, 5e9, 8e9, 1e10)
+        gain_range = sigfile.GAIN_RANGE
 
         channel = self.channels[cid]
         data = self.data[cid]
         sample_rate = self.channel_rate[cid]
 
-        try:
-            sample_rate_index = sample_rates.index(sample_rate)
-        except ValueError:
-            sample_rate_index = 47  # External clock index
+        sample_rate_index = sigfile.sample_rate_index(sample_rate)
 
         try:
             gain_index = gain_range.index(channel.input_range / 1000)
@@ -153,10 +204,11 @@ class GageIteration(object):
     cur_trigger = 0
     last_trigger = None
 
-    def __init__(self, triggers, last_trigger=None):
+    def __init__(self, triggers, last_trigger=None, stats=None):
         self.triggers = triggers
         self.captures = {}
         self.last_trigger = last_trigger
+        self.stats = stats  # RunStatistics counting extra and missed triggers, passed on to the next iterations
 
     def __del__(self):
         log('GageIteration Deleted', 7)
@@ -171,15 +223,18 @@ class GageIteration(object):
 
         if detected_trigger < 0:
             log('Extra trigger at {}! ignoring.'.format(capture.timestamp))
+            self._count('extra')
             return detected_trigger, next_iteration
         elif detected_trigger == self.cur_trigger:
             self.captures[detected_trigger] = capture
         else:
             log('Missed trigger #{} at {}!'.format(self.cur_trigger, capture.timestamp))
+            skipped = detected_trigger if detected_trigger > 0 else len(self.triggers)
+            self._count('missed_skip', skipped - self.cur_trigger)
 
             if detected_trigger == 0:
                 # First trigger of next iteration
-                next_iteration = GageIteration(self.triggers, last_trigger=capture.timestamp)
+                next_iteration = GageIteration(self.triggers, last_trigger=capture.timestamp, stats=self.stats)
                 next_iteration.captures[0] = capture
                 next_iteration.cur_trigger = 1
             # TODO check for bug if nTriggers=1 (missed trigger detection is kind of pointless here...)
@@ -191,10 +246,14 @@ class GageIteration(object):
         if self.cur_trigger == len(self.triggers):
             # the next trigger is the first of the next iteration. Return a new empty iteration object,
             # initialized with the last_trigger
-            next_iteration = GageIteration(self.triggers, last_trigger=self.last_trigger)
+            next_iteration = GageIteration(self.triggers, last_trigger=self.last_trigger, stats=self.stats)
 
         return detected_trigger, next_iteration
 
+    def _count(self, name, n=1):
+        if self.stats is not None:
+            self.stats.count(name, n)
+
     def check_trigger(self, expected_trigger, timestamp, tolerance=0.4):
 
         if not self.last_trigger:
@@ -260,12 +319,13 @@ class GageIteration(object):
             # If expected trigger is passed
 
             log('Missed trigger {} at {}!'.format(self.cur_trigger, now))
+            self._count('missed_timeout')
             self.last_trigger = expected_timestamp
             self.cur_trigger = self.cur_trigger + 1
 
             if self.cur_trigger >= len(self.triggers):
                 # Missed last trigger, return a new empty iteration
-                return GageIteration(self.triggers, last_trigger=self.last_trigger)
+                return GageIteration(self.triggers, last_trigger=self.last_trigger, stats=self.stats)
 
             _, timeout = self.triggers[self.cur_trigger]
             expected_timestamp = self.last_trigger + datetime.timedelta(seconds=timeout)
@@ -286,30 +346,48 @@ class GageIteration(object):
 
         return remaining.total_seconds() * 1000.0
 
-    def save_h5(self, filename):
+    def first_capture(self):
+        return self.captures[min(self.captures)]
 
-        with h5py.File(filename, 'w') as hf:
-            trigger = self.captures[0].trigger
-            info = self.captures[0].info
+    def write_attrs(self, hf):
+        # Global and per-channel attributes, taken from the first capture of the iteration
+        capture = self.first_capture()
+        trigger = capture.trigger
+        info = capture.info
 
-            hf.attrs['board_type'] = info.board_type
-            hf.attrs['trigger_slope'] = 1 if trigger.condition else 2,  # 1 for rising edge, 2 for falling edge
-            hf.attrs['trigger_level'] = trigger.level
-            hf.attrs['trigger_coupling'] = trigger.ext_coupling
-            hf.attrs['trigger_gain'] = trigger.ext_trigger_range
+        hf.attrs['board_type'] = info.board_type
+        hf.attrs['trigger_slope'] = 1 if trigger.condition else 2,  # 1 for rising edge, 2 for falling edge
+        hf.attrs['trigger_level'] = trigger.level
+        hf.attrs['trigger_coupling'] = trigger.ext_coupling
+        hf.attrs['trigger_gain'] = trigger.ext_trigger_range
 
-            acquisition = self.captures[0].acquisition
+        acquisition = capture.acquisition
 
-            for cid, channel in self.captures[0].channels.items():
-                hg = hf.create_group('ch{}'.format(cid))
+        for cid, channel in capture.channels.items():
+            hg = hf.require_group('ch{}'.format(cid))
 
-                hg.attrs['input_range'] = channel.input_range
-                hg.attrs['dc_offset'] = channel.dc_offset
-                hg.attrs['sample_res'] = acquisition.sample_res
-                hg.attrs['sample_offset'] = acquisition.sample_offset
-                hg.attrs['input_range'] = channel.input_range
-                hg.attrs['input_coupling'] = channel.term
-                hg.attrs['input_impedance'] = channel.impedance
+            hg.attrs['input_range'] = channel.input_range
+            hg.attrs['dc_offset'] = channel.dc_offset
+            hg.attrs['sample_res'] = acquisition.sample_res
+            hg.attrs['sample_offset'] = acquisition.sample_offset
+            hg.attrs['input_coupling'] = channel.term
+            hg.attrs['input_impedance'] = channel.impedance
+            if capture.channel_config[cid].name is not None:
+                hg.attrs['name'] = capture.channel_config[cid].name
+
+    @trace.traced('save_h5')
+    def save_h5(self, filename):
+        # Returns {cid: (compression ratio, write time in s)}, also stored as attributes of each channel group
+        stats = {}
+
+        with h5py.File(filename, 'w') as hf:
+            self.write_attrs(hf)
+            hf.attrs['prefixes'] = [prefix for prefix, timeout in self.triggers]
+
+            for cid in self.first_capture().channels:
+                hg = hf['ch{}'.format(cid)]
+                write_start = time.perf_counter()
+                raw_size = 0
 
                 for idx, values in enumerate(self.triggers):
                     prefix, timeout = values
@@ -318,58 +396,178 @@ class GageIteration(object):
                         continue
 
                     capture = self.captures[idx]
-                    acquisition = capture.acquisition
-
-                    def get_field_name(field_prefix, field_name):
-                        if len(field_prefix) > 0:
-                            return "{}_{}".format(field_prefix, field_name)
-                        else:
-                            return field_name
 
                     ts_att = get_field_name(prefix, 'timestamp')
                     hf.attrs[ts_att] = capture.timestamp.isoformat()
 
-                    segments = capture.channel_config[cid].segments
-                    dx = 1.0 / capture.channel_rate[cid]
-
-                    for name, start, stop in segments:  # start, stop in ms
-                        imin = int(math.floor(start / 1e3 / dx))
-                        imax = int(math.ceil(stop / 1e3 / dx))
-                        x0 = imin * dx
-                        seg_data = capture.data[cid][imin:imax]
+                    config = capture.channel_config[cid]
+                    options = config.dataset_options
 
+                    for name, x0, dx, seg_data in capture.get_segments(cid):
                         dataset_name = get_field_name(prefix, name)
-                        dset = hg.create_dataset(dataset_name, data=seg_data)
+                        dset = hg.create_dataset(dataset_name, data=seg_data, **options(len(seg_data)))
                         dset.attrs['x0'] = x0
                         dset.attrs['dx'] = dx
+                        dset.attrs['trigger'] = idx
+                        dset.attrs['segment'] = name
+                        raw_size += seg_data.nbytes
+
+                        if config.preview:
+                            write_pyramid(hf.require_group('{}/ch{}'.format(PREVIEW_GROUP, cid)), dataset_name,
+                                          seg_data, x0, dx, config.preview)
+
+                hf.flush()
+                write_time = time.perf_counter() - write_start
+
+                stored_size = sum(dset.id.get_storage_size() for dset in hg.values())
+                ratio = raw_size / stored_size if stored_size > 0 else 1.0
+
+                hg.attrs['compression_ratio'] = ratio
+                hg.attrs['write_time'] = write_time
+                stats[cid] = (ratio, write_time)
+
+        return stats
 
 
 class GageWorker(QtCore.QObject):
-    plot_capture = QtCore.Signal(object, int)
+    plot_capture = QtCore.Signal(object, int, object)
+    plot_average = QtCore.Signal(object, int)
+    photon_counts = QtCore.Signal(object)
 
-    def __init__(self):
+    def __init__(self, writer=None, spool=None, catalog=None, stats=None, latency=None, latency_dump=None):
         super(GageWorker, self).__init__()
 
+        self.writer = writer
+        self.spool = spool
+        self.catalog = catalog
+        self.stats = stats  # RunStatistics of the current run
+        # PipelineTimer of the current run, saved as latency.csv or latency.h5 (latency_dump 'csv' or 'h5')
+        self.latency = latency
+        self.latency_dump = latency_dump
+        self._statistics_target = None
+
+        # Captures processed so far. Only written by the worker thread; the acquisition thread compares it to the
+        # captures it queued to bound the backlog.
+        self.processed = 0
+        self._last_sequence = None
+
     def __del__(self):
         log('GageWorker Deleted', 7)
 
     def started(self):
         pass
 
+    def stopped(self):
+        self._end_statistics()
+
+    def run_status(self, running):
+        # Run statistics are restarted with every run, and saved to the run directory when it ends
+        if running:
+            self._statistics_target = self.run_widget.getTargetH5()[1]
+            if self.latency is not None:
+                self.latency.reset()
+            if self.stats is not None:
+                self.stats.reset()
+        else:
+            self._end_statistics()
+
+    def _end_statistics(self):
+        if self._statistics_target is None:
+            return
+
+        if self.latency is not None and self.latency.empty_stages():
+            log('No latency samples of stages {}'.format(', '.join(self.latency.empty_stages())), 1)
+
+        # Snapshots, written by the writer like any other file of the run
+        if self.latency is not None and self.latency_dump == 'h5':
+            self.write(path.join(self._statistics_target, 'latency.h5'), self.latency.copy().dump_h5)
+        elif self.latency is not None and self.latency_dump is not None:
+            self.write(path.join(self._statistics_target, 'latency.csv'), self.latency.copy().dump_csv)
+        if self.stats is not None:
+            self.write(path.join(self._statistics_target, 'run_stats.h5'), self.stats.copy().dump_h5)
+        self._statistics_target = None
+
+    @trace.traced('process_capture')
     def process_capture(self, capture):
         # Resample data
         log('Processing started', 7)
 
-        capture.resample()
-        self._process(capture)
+        try:
+            capture.resample()
+            capture.stamp('resample')
+            if self.stats is not None:
+                self.stats.count('seen')
+                # Captures dropped in front of this one, the triggers they leave missing are not counted again
+                dropped = 0
+                if capture.sequence is not None and self._last_sequence is not None:
+                    dropped = max(capture.sequence - self._last_sequence - 1, 0)
+                self._last_sequence = capture.sequence
+                self.stats.captured(dropped)
+            self._process(capture)
+        finally:
+            # Also counts failed captures, which would otherwise stay in the backlog forever
+            self.processed += 1
 
         log('Processing completed', 7)
 
+    def _count_photons(self, capture, trigger):
+        counts = capture.count_photons(trigger)
+        if len(counts) == 0:
+            return
+
+        self.photon_counts.emit(counts)
+
+        if counts['saturated'].any():
+            log('SPCM saturated!!! Turn down the power!', rate_limit=10.0)
+
+    def write(self, filepath, func, nbytes=0, migrate=True, entries=None, companions=()):
+        # Queue the write on the write-behind saver if there is one, otherwise write directly.
+        # Completed files, and the companions func writes next to them, are handed to the spool (if any) to be moved
+        # to the data root, unless migrate is False.
+        # entries(relpath, mtime) returns the catalog rows of the written file, added once it has been migrated.
+        migrate = self.spool is not None and migrate and filepath is not None
+        entries = entries if self.catalog is not None and filepath is not None else None
+        if migrate or entries is not None:
+            func = partial(self._write_complete, func, migrate, entries, companions)
+
+        if self.writer is not None:
+            self.writer.submit(filepath, func, nbytes)
+            return
+
+        if filepath is not None:
+            target_path = path.dirname(filepath)
+            if not path.exists(target_path):
+                os.makedirs(target_path)
+
+        flush = func(filepath)
+        if flush is not None:
+            flush()
+
+    def _write_complete(self, func, migrate, entries, companions, filepath):
+        flush = func(filepath)
+
+        # The modification time is kept by the spool, and compared by index_archive to skip files already cataloged
+        mtime = path.getmtime(filepath) if entries is not None and path.exists(filepath) else None
+        if migrate:
+            self.spool.submit(filepath)
+            for companion in companions:
+                if path.exists(companion):
+                    self.spool.submit(companion)
+
+        if entries is not None:
+            # The file has been written whatever happens to the catalog (which may be locked by another process)
+            try:
+                self.catalog.add(entries(self.catalog.relpath(filepath), mtime=mtime))
+            except sqlite3.Error as e:
+                log('Could not catalog {}: {}'.format(path.basename(filepath), e))
+        return flush
+
 
 class GageTradWorker(GageWorker):
 
-    def __init__(self, run_widget):
-        super(GageTradWorker, self).__init__()
+    def __init__(self, run_widget, writer=None, spool=None, catalog=None, stats=None, latency=None,
+                 latency_dump=None):
+        super(GageTradWorker, self).__init__(writer, spool, catalog, stats, latency, latency_dump)
 
         self.run_widget = run_widget
 
@@ -378,34 +576,69 @@ class GageTradWorker(GageWorker):
         if self.run_widget.isRunning():
             for cid, config in capture.channel_config.items():
                 filename, target_path = self.run_widget.getTarget(channel=cid)
-                if not path.exists(target_path):
-                    os.makedirs(target_path)
-
                 filepath = path.join(target_path, filename)
-                capture.save_channel_sig(filepath, cid)
-
-                log('Output to {}'.format(filename), 1)
+                companions = [sidecar_name(filepath)] if config.preview else []
+                self.write(filepath, partial(self._write_sig, capture, cid), capture.data[cid].nbytes,
+                           entries=partial(entries_from_capture, capture=capture, cid=cid,
+                                           number=self.run_widget.cur_file), companions=companions)
 
             self.run_widget.increment()
 
         plot_data = capture.prepare_plot()
-        self.plot_capture.emit(plot_data, 0)
+        capture.stamp('filter')
+        self.plot_capture.emit(plot_data, 0, capture)
+        self._count_photons(capture, 0)
+
+    @staticmethod
+    def _write_sig(capture, cid, filepath):
+        capture.stamp('save_start')
+        capture.save_channel_sig(filepath, cid)
+        if capture.channel_config[cid].preview:
+            capture.save_channel_preview(filepath, cid)
+        capture.stamp('save')
+
+        log('Output to {}'.format(path.basename(filepath)), 1)
 
 
 class GageSegWorker(GageWorker):
 
-    def __init__(self, run_widget, triggers):
-        super(GageSegWorker, self).__init__()
+    def __init__(self, run_widget, triggers, run_store=False, store_iterations=None, store_options=None,
+                 writer=None, spool=None, catalog=None, averages=False, save_averages=False, store_counts=False,
+                 stats=None, latency=None, latency_dump=None):
+        super(GageSegWorker, self).__init__(writer, spool, catalog, stats, latency, latency_dump)
 
         self.run_widget = run_widget
-        self.iteration = GageIteration(triggers)
+        self.iteration = GageIteration(triggers, stats=stats)
         self.trigger_timer = None
+        self.flush_timer = None
+
+        # Running mean and variance of the filtered traces, per channel and trigger step. Restarted with every run,
+        # and saved to averages.h5 in the run directory when the run ends if save_averages is set.
+        self.averages = {} if averages else None
+        self.save_averages = save_averages
+        self._averages_target = None
+
+        # Append iterations to a run-level store (one file per run, or per store_iterations iterations)
+        # instead of writing one file per iteration
+        self.run_store = run_store
+        self.store_iterations = store_iterations
+        self.store_options = store_options if store_options is not None else {}
+        self.store = None
+        # Also append the photon counts of every iteration to the run store
+        self.store_counts = store_counts
 
     def started(self):
         self.trigger_timer = QtCore.QTimer()
         self.trigger_timer.timeout.connect(self._check_timeout)
         self.trigger_timer.start(1000)
 
+        # Flushes of the run store are rate limited, flush the last iterations once appends pause
+        flush_interval = self.store_options.get('flush_interval')
+        if self.run_store and flush_interval:
+            self.flush_timer = QtCore.QTimer()
+            self.flush_timer.timeout.connect(self._deferred_flush)
+            self.flush_timer.start(int(flush_interval * 1000))
+
     def _process(self, capture):
         (detected_trigger, next_iteration) = self.iteration.capture_trigger(capture)
         if detected_trigger < 0:
@@ -416,23 +649,145 @@ class GageSegWorker(GageWorker):
             self._save_iteration(self.iteration)
             self.iteration = next_iteration
 
-        plot_data = capture.prepare_plot()
-        self.plot_capture.emit(plot_data, detected_trigger)
+        plot_data = capture.prepare_plot(detected_trigger)
+        capture.stamp('filter')
+        self.plot_capture.emit(plot_data, detected_trigger, capture)
+        self._count_photons(capture, detected_trigger)
+
+        if self.averages is not None:
+            self._update_averages(capture, plot_data, detected_trigger)
+
+    def _update_averages(self, capture, plot_data, trigger):
+        average_data = {}
+        for cid, (filt_time, filt_data) in plot_data.items():
+            average = self.averages.setdefault((cid, trigger), RunningAverage())
+            average.update(*capture.channel_config[cid].filter.average_grid(filt_time, filt_data))
+            # Copies, the accumulators keep changing while the UI draws
+            average_data[cid] = (average.t, average.mean.copy(), average.std)
+
+        self.plot_average.emit(average_data, trigger)
+
+    def stopped(self):
+        self._end_averages()
+        super(GageSegWorker, self).stopped()
+        self.write(None, self._close_store)
+
+    def run_status(self, running):
+        super(GageSegWorker, self).run_status(running)
+        if running:
+            if self.averages is not None:
+                self.averages = {}
+                self._averages_target = self.run_widget.getTargetH5()[1]
+        else:
+            self._end_averages()
+            self.write(None, self._close_store)
+
+    def _end_averages(self):
+        if self.averages and self.save_averages and self._averages_target is not None:
+            # Hand the accumulators over to the writer and start new ones
+            averages, self.averages = self.averages, {}
+            filepath = path.join(self._averages_target, 'averages.h5')
+            self.write(filepath, partial(self._write_averages, averages, self.iteration.triggers))
+        self._averages_target = None
+
+    @staticmethod
+    def _write_averages(averages, triggers, filepath):
+        with h5py.File(filepath, 'w') as hf:
+            for (cid, trigger), average in sorted(averages.items()):
+                hg = hf.require_group('ch{}'.format(cid))
+                prefix = triggers[trigger][0]
+
+                for name, data in (('t', average.t), ('mean', average.mean), ('std', average.std)):
+                    hg.create_dataset(get_field_name(prefix, name), data=data)
+                hg[get_field_name(prefix, 'mean')].attrs['count'] = average.count
+
+        log('Output to {}'.format(path.basename(filepath)), 1)
 
     def _save_iteration(self, iteration):
         if not self.run_widget.isRunning():
             return
 
-        filename, target_path = self.run_widget.getTargetH5()
-        if not path.exists(target_path):
-            os.makedirs(target_path)
-        filepath = path.join(target_path, filename)
-        iteration.save_h5(filepath)
+        nbytes = sum(data.nbytes for capture in iteration.captures.values() for data in capture.data.values())
 
-        log('Output to {}'.format(filename), 1)
+        if self.run_store:
+            filename, target_path = self.run_widget.getTargetStore(self.store_iterations)
+            filepath = path.join(target_path, filename)
+            self.write(filepath, partial(self._store_iteration, iteration, self.run_widget.cur_file), nbytes,
+                       migrate=False, entries=partial(entries_from_iteration, iteration=iteration,
+                                                      number=self.run_widget.cur_file, kind='store'))
+        else:
+            filename, target_path = self.run_widget.getTargetH5()
+            filepath = path.join(target_path, filename)
+            self.write(filepath, partial(self._write_h5, iteration), nbytes,
+                       entries=partial(entries_from_iteration, iteration=iteration, number=self.run_widget.cur_file))
 
         self.run_widget.increment()
 
+    @staticmethod
+    def _write_h5(iteration, filepath):
+        for capture in iteration.captures.values():
+            capture.stamp('save_start')
+        stats = iteration.save_h5(filepath)
+        for capture in iteration.captures.values():
+            capture.stamp('save')
+
+        log('Output to {}'.format(path.basename(filepath)), 1)
+        for cid, (ratio, write_time) in stats.items():
+            log('Channel {}: compression ratio {:.2f}, write time {:.1f} ms'.format(cid, ratio, write_time * 1e3), 3)
+
+    def _store_iteration(self, iteration, number, filepath):
+        # Runs on the writer thread when write-behind is enabled. The store is only ever touched from there.
+        if self.store is None or self.store.filename != filepath:
+            self._close_store()
+            if self.spool is not None:
+                self._unspool_store(filepath)
+            self.store = GageRunStore(filepath, iteration.triggers, **self.store_options)
+            log('Output to {}'.format(path.basename(filepath)), 1)
+
+        for capture in iteration.captures.values():
+            capture.stamp('save_start')
+        self.store.append(iteration, number, flush=False)
+        for capture in iteration.captures.values():
+            capture.stamp('save')
+
+        if self.store_counts:
+            counts = [capture.photon_counts for capture in iteration.captures.values()
+                      if capture.photon_counts is not None]
+            if len(counts) > 0:
+                counts = np.concatenate(counts)
+                counts['iteration'] = number
+                self.store.append_counts(counts)
+
+        return self.store.flush
+
+    def _unspool_store(self, filepath):
+        # Continue appending to a store that was handed to the spool, instead of replacing it. A pending move is taken
+        # back, so only a copy in progress holds up the writer, not the retries of a failing one.
+        while not self.spool.reclaim(filepath, timeout=10.0):
+            log('Waiting for {} to be moved to the data root'.format(path.basename(filepath)))
+
+        target = self.spool.target(filepath)
+        if not path.exists(filepath) and path.exists(target):
+            shutil.copy2(target, filepath)
+
+    def _deferred_flush(self):
+        store = self.store
+        if store is not None and store.unflushed:
+            self.write(None, self._flush_store)
+
+    def _flush_store(self, filepath=None):
+        # Runs on the writer thread, like every other access to the store
+        if self.store is not None:
+            self.store.flush()
+
+    def _close_store(self, filepath=None):
+        if self.store is not None:
+            self.store.close()
+            # The store is complete only once closed
+            if self.spool is not None:
+                self.spool.submit(self.store.filename)
+            self.store = None
+
     def _check_timeout(self):
         # log('Trigger Timeout ({})'.format(self.iteration.cur_trigger), 5)
 
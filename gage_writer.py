@@ -0,0 +1,159 @@
+from __future__ import division, print_function
+import os
+import threading
+import time
+from os import path
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from gage_util import log
+
+
+class GageWriter(object):
+    """
+    Write-behind saver. Workers submit (filepath, write function) jobs to a bounded queue, and a dedicated thread
+    executes them, so a slow data drive does not block processing.
+
+    A write function is called as func(filepath) and may return a flush callable. Flushes returned by the jobs of
+    one batch are coalesced and called once per batch.
+    """
+
+    def __init__(self, max_queue=64, batch_size=16, fsync_interval=None):
+        self.batch_size = batch_size
+        self.fsync_interval = fsync_interval
+
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._thread = None
+        self._dirs = set()
+        self._fsync_pending = set()
+        self._last_fsync = time.perf_counter()
+
+        self._lock = threading.Lock()
+        self.bytes_written = 0
+        self.busy_time = 0.0
+        self.jobs_written = 0
+        self.errors = 0
+        self._last_stats = (time.perf_counter(), 0)
+
+    def start(self):
+        if self._thread is not None:
+            return
+
+        self._thread = threading.Thread(target=self._run, name='GageWriter')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        # Write out everything still queued, then stop the writer thread
+        if self._thread is None:
+            return
+
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+
+    def submit(self, filepath, func, nbytes=0):
+        if self._queue.full():
+            log('Write queue full ({} jobs), waiting for data drive'.format(self._queue.qsize()), rate_limit=5.0,
+                key='queue full')
+        self._queue.put((filepath, func, nbytes))
+
+    @property
+    def depth(self):
+        return self._queue.qsize()
+
+    def stats(self):
+        # Returns (queue depth, MB/s since the last call, MB/s while writing)
+        now = time.perf_counter()
+        with self._lock:
+            bytes_written = self.bytes_written
+            busy_time = self.busy_time
+
+        last_time, last_bytes = self._last_stats
+        self._last_stats = (now, bytes_written)
+
+        rate = (bytes_written - last_bytes) / (now - last_time) / 1e6 if now > last_time else 0.0
+        disk_rate = bytes_written / busy_time / 1e6 if busy_time > 0 else 0.0
+
+        return self.depth, rate, disk_rate
+
+    def makedirs(self, target_path):
+        if target_path in self._dirs:
+            return
+
+        if not path.exists(target_path):
+            os.makedirs(target_path)
+        self._dirs.add(target_path)
+
+    def _run(self):
+        running = True
+
+        while running:
+            batch = [self._queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            if None in batch:
+                running = False
+                batch = [job for job in batch if job is not None]
+
+            self._write_batch(batch)
+
+        self._fsync()
+
+    def _write_batch(self, batch):
+        start = time.perf_counter()
+        nbytes = 0
+        flushes = []
+
+        for filepath, func, job_bytes in batch:
+            try:
+                if filepath is not None:
+                    self.makedirs(path.dirname(filepath))
+
+                flush = func(filepath)
+                if flush is not None and flush not in flushes:
+                    flushes.append(flush)
+
+                if filepath is not None and self.fsync_interval is not None:
+                    self._fsync_pending.add(filepath)
+
+                nbytes += job_bytes
+            except Exception as e:
+                self.errors += 1
+                log('Error writing {}: {}'.format(filepath, e))
+
+        for flush in flushes:
+            try:
+                flush()
+            except Exception as e:
+                self.errors += 1
+                log('Error flushing: {}'.format(e))
+
+        if self.fsync_interval is not None and time.perf_counter() - self._last_fsync > self.fsync_interval:
+            self._fsync()
+
+        with self._lock:
+            self.bytes_written += nbytes
+            self.busy_time += time.perf_counter() - start
+            self.jobs_written += len(batch)
+
+    def _fsync(self):
+        for filepath in self._fsync_pending:
+            try:
+                fd = os.open(filepath, os.O_RDWR)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+            except OSError as e:
+                log('Error syncing {}: {}'.format(filepath, e), 1)
+
+        self._fsync_pending = set()
+        self._last_fsync = time.perf_counter()
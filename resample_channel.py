@@ -2,15 +2,20 @@ from __future__ import division, print_function
 import numpy as np
 import csapi
 import os
-import matplotlib.pyplot as plt
 from math import floor
 import fnmatch
 from os import makedirs, path
 from datetime import datetime
 import signal, time
 import sys
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from contextlib import nullcontext
 
-from gage_util import e3decimate
+from gage_util import e3decimate_blocks
+import sigfile
+import sigscan
 
 # This script recursively scans through old GageScope signal files, and downsamples the selected channel to a lower sample rate. 
 # The original file can be moved to a backup location
@@ -25,78 +30,99 @@ def signal_handling(signum,frame):
 signal.signal(signal.SIGINT,signal_handling) 
 	
 	
-sample_rates = (1.0, 2.0, 5.0, 10.0, 20.0, 50.0, 100.0, 200.0, 500.0, 1e3, 2e3, 5e3, 1e4, 2e4, 5e4, 1e5, 2e5, 5e5,
-		1e6, 2e6, 2.5e6, 5e6, 1e7, 1.25e7, 2e7, 2.5e7, 3e7, 4e7, 5e7, 6e7, 6.5e7, 8e7, 
-		1e8, 1.2e8, 1.25e8, 1.3e8, 1.5e8, 2e8, 2.5e8, 3e8, 5e8, 1e9, 2e9, 4e9, 5e9, 8e9, 1e10)
+sample_rates = sigfile.SAMPLE_RATES
 
-def resample_file(filepath, resample_rate, target=None, moveorig=None):
+class LockedReader(object):
+	# Array-like view of data, that copies requested slices into memory while holding lock
+	
+	def __init__(self, data, lock):
+		self.data = data
+		self.lock = lock
+		
+	def __len__(self):
+		return len(self.data)
+	
+	def __getitem__(self, index):
+		with self.lock:
+			return np.array(self.data[index])
+
+def resample_file(filepath, resample_rate, target=None, moveorig=None, io_lock=None, block_size=1 << 20):
+	# Streams the file through the decimation filter in blocks of block_size samples, so memory use does not depend
+	# on the file size. io_lock (e.g. a semaphore) is held while reading or writing a block, but not while filtering.
+	# The output is written to a temporary file next to the target, and the header is patched in at the end.
 
 	if target is None:
 		target = filepath
+	
+	if io_lock is None:
+		io_lock = nullcontext()
+	
+	partial_target = target + '.part'
 
-	header = csapi.SigFileHeader()
-	with open(filepath, 'rb') as f:
-		f.readinto(header)
-		data = np.fromfile(f, dtype=np.int16)
-
-	ext_clk_rate = header.external_clock_rate	
-	if header.sample_rate_index < 47:
-		sample_rate = sample_rates[header.sample_rate_index]
-	else:
-		sample_rate = ext_clk_rate
+	with sigfile.open_sig(filepath) as sig:
+		header = sig.header.copy()
+		length = len(sig.data)
+		data = LockedReader(sig.data, io_lock)
 
-	decimation_factor =  int(floor(sample_rate / resample_rate))
-	#~ print('Decimation factor: {:d}'.format(decimation_factor))
-	if decimation_factor > 1:
-		filtered = e3decimate(data, decimation_factor, n=6).astype(np.int16)
-	
-		new_sample_rate = sample_rate / decimation_factor
-		new_ext_clk_rate = header.external_clock_rate / decimation_factor
+		sample_rate = sigfile.header_sample_rate(header)
+		decimation_factor =  int(floor(sample_rate / resample_rate))
+		#~ print('Decimation factor: {:d}'.format(decimation_factor))
+		
+		if decimation_factor > 1:
+			blocks = e3decimate_blocks(data, decimation_factor, n=6, block_size=block_size)
+			new_length = len(range(0, length, decimation_factor))
+		else:
+			blocks = (data[start:start + block_size] for start in range(0, length, block_size))
+			new_length = length
 		
-		try:
-			header.sample_rate_index = sample_rates.index(new_sample_rate)
-		except ValueError:
-			header.sample_rate_index = 47 #External clock index
+		with open(partial_target, 'wb') as f:
+			# Pre-size the output
+			f.truncate(sigfile.SIG_HEADER_SIZE + 2 * new_length)
+			f.seek(sigfile.SIG_HEADER_SIZE)
 			
-		header.external_tbs=1e9/new_ext_clk_rate
-		header.external_clock_rate=new_ext_clk_rate
+			for block in blocks:
+				block = block.astype(np.int16)
+				with io_lock:
+					f.write(block.tobytes())
 		
-		header.trigger_depth=len(filtered)
-		header.sample_depth=len(filtered)
-		header.ending_address=len(filtered)-1
-		header.record_depth=len(filtered)
+			if decimation_factor > 1:
+				new_sample_rate = sample_rate / decimation_factor
+				new_ext_clk_rate = header['external_clock_rate'] / decimation_factor
+				
+				header['sample_rate_index'] = sigfile.sample_rate_index(new_sample_rate)
+					
+				header['external_tbs']=1e9/new_ext_clk_rate
+				header['external_clock_rate']=new_ext_clk_rate
+				
+				header['trigger_depth']=new_length
+				header['sample_depth']=new_length
+				header['ending_address']=new_length-1
+				header['record_depth']=new_length
+			
+			with io_lock:
+				f.seek(0)
+				f.write(header.tobytes())
 		
-	else:
-		filtered = data
+		data = None
+		blocks = None
 		
-	atime = (datetime.now() - datetime.fromtimestamp(0)).total_seconds()
-	mtime = os.path.getmtime( filepath )
+	with io_lock:
+		atime = (datetime.now() - datetime.fromtimestamp(0)).total_seconds()
+		mtime = os.path.getmtime( filepath )
 
-	if moveorig is not None:
-		os.rename(filepath, moveorig)
+		if moveorig is not None:
+			os.rename(filepath, moveorig)
 
-	with open(target, 'wb') as f:
-		f.write(header)
-		f.write(filtered.astype(np.int16).tobytes())
-		
-	os.utime(target, (atime ,mtime))
+		os.replace(partial_target, target)
+		os.utime(target, (atime ,mtime))
 
-	return (data, filtered, sample_rate, decimation_factor)
+	return (sample_rate, decimation_factor)
 
 def read_file_samplerate(filepath):
-	header = csapi.SigFileHeader()
-	with open(filepath, 'rb') as f:
-		f.readinto(header)
-
-	ext_clk_rate = header.external_clock_rate	
-	if header.sample_rate_index < 47:
-		sample_rate = sample_rates[header.sample_rate_index]
-	else:
-		sample_rate = ext_clk_rate
-		
-	return sample_rate
+	return sigfile.header_sample_rate(sigfile.read_header(filepath))
 
 def plot_resample(data, filtered, sample_rate, decimation_factor):
+	import matplotlib.pyplot as plt
 	
 	plt.figure()
 	
@@ -119,66 +145,161 @@ def resample_folder(path, resample_rate):
 			else:
 				print('Skipping {} with sample rate {:.1f}MHz.'.format(filename, sample_rate/1e6))
 
-def resample_channel_recursive(root, channel, resample_rate, backup=None):
+io_semaphore = None
+
+def _init_worker(semaphore):
+	global io_semaphore
+	io_semaphore = semaphore
+	signal.signal(signal.SIGINT, signal.SIG_IGN) # Only the main process handles Ctrl-C, running files are finished
+
+def _resample_task(filepath, resample_rate, backuppath):
+	# Runs in a worker process. Returns the input file size and the decimation factor.
+	size = path.getsize(filepath)
+	
+	if backuppath is not None:
+		backupdir = path.dirname(backuppath)
+		if not path.exists(backupdir):
+			makedirs(backupdir, exist_ok=True)
+
+	_, decimation_factor = resample_file(filepath, resample_rate, moveorig=backuppath, io_lock=io_semaphore)
+	return size, decimation_factor
+
+def read_journal(journal):
+	# Paths of files completed by earlier passes
+	if journal is None or not path.exists(journal):
+		return set()
+	
+	with open(journal, 'r') as f:
+		return set(line.rstrip('\n').split('\t')[0] for line in f if line.strip())
+
+class Progress(object):
+	
+	def __init__(self, total_files, total_bytes):
+		self.total_files = total_files
+		self.total_bytes = total_bytes
+		self.files = 0
+		self.bytes = 0
+		self.start = time.perf_counter()
+		self.last_report = 0
+		
+	def update(self, size, interval=5.0):
+		self.files += 1
+		self.bytes += size
+		
+		now = time.perf_counter()
+		if now - self.last_report >= interval:
+			self.last_report = now
+			print(self.report())
+		
+	def report(self):
+		elapsed = max(time.perf_counter() - self.start, 1e-9)
+		byte_rate = self.bytes / elapsed
+		eta = (self.total_bytes - self.bytes) / byte_rate if byte_rate > 0 else float('nan')
+		return '{:d}/{:d} files, {:.1f} files/s, {:.1f} MB/s, ETA {:.0f} s'.format(
+			self.files, self.total_files, self.files / elapsed, byte_rate / 1e6, eta)
+
+def resample_channel_recursive(root, channel, resample_rate, backup=None, manifest=None, workers=None, io_limit=2,
+		journal=None):
+	# Resamples all files of a channel below root on a pool of worker processes, with at most io_limit files being
+	# read or written at the same time. Completed files are appended to the journal, and skipped on the next pass.
 	print('Scanning path {}'.format(root))
-	for pathname, dirnames, filenames in os.walk(root):
-		if terminate:
-			break
-			
-		if fnmatch.fnmatch(pathname, '*_CH{:02d}/Folder.00001'.format(channel)):
-			print("Found channel #{} at {}:".format(channel, pathname))
-			 
-			for filename in fnmatch.filter(filenames, 'AS_CH{:02d}-*.sig'.format(channel)):
-				if terminate:
-					break
-				
-				
-				filepath = path.join(pathname, filename)
-				sample_rate = read_file_samplerate(filepath)
-				if sample_rate > resample_rate:
-					print('Resampling {} from {:.1f}MHz...'.format(filename, sample_rate/1e6))
+	headers = sigscan.scan_headers(root, pattern='AS_CH{:02d}-*.sig'.format(channel),
+		dir_pattern='*_CH{:02d}/Folder.00001'.format(channel), manifest=manifest)
+	headers = headers[headers['valid']]
+	rates = sigscan.sample_rates(headers['header'])
+	
+	done = read_journal(journal)
+	todo = [entry for entry, sample_rate in zip(headers, rates)
+		if sample_rate > resample_rate and str(entry['path']) not in done]
+	print("Found {:d} files of channel #{}, {:d} to resample ({:d} done in earlier passes)".format(
+		len(headers), channel, len(todo), len(done)))
 
-					if backup is not None:
-						runpath = path.relpath(pathname, root)
-						backupdir = path.join(backup, runpath)
-						backuppath = path.join(backupdir, filename)
+	if workers is None:
+		workers = multiprocessing.cpu_count()
+	
+	progress = Progress(len(todo), int(sum(entry['size'] for entry in todo)))
+	semaphore = multiprocessing.Manager().BoundedSemaphore(io_limit)
+	journal_file = open(journal, 'a') if journal is not None else None
 	
-						print('Moving original to backup location "{}".'.format(backuppath))					
-						if not path.exists(backupdir):
-							makedirs(backupdir)
+	try:
+		with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(semaphore,)) as executor:
+			pending = {}
+			queue = iter(todo)
+			
+			while True:
+				# Keep a bounded number of files in flight, so an interrupt stops quickly
+				while not terminate and len(pending) < 2 * workers:
+					entry = next(queue, None)
+					if entry is None:
+						break
+					
+					filepath = str(entry['path'])
+					if backup is not None:
+						backuppath = path.join(backup, path.relpath(filepath, root))
 					else:
 						backuppath = None
-
-					resample_file(filepath, resample_rate, moveorig=backuppath)
 					
-				else:
-					print('Skipping {} with sample rate {:.1f}MHz.'.format(filename, sample_rate/1e6))	
+					pending[executor.submit(_resample_task, filepath, resample_rate, backuppath)] = filepath
+				
+				if len(pending) == 0:
+					break
+				
+				finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+				for future in finished:
+					filepath = pending.pop(future)
+					try:
+						size, decimation_factor = future.result()
+					except Exception as e:
+						print('Error resampling {}: {}'.format(filepath, e))
+						continue
+					
+					if journal_file is not None:
+						journal_file.write('{}\t{:d}\n'.format(filepath, decimation_factor))
+						journal_file.flush()
+					
+					progress.update(size)
+	finally:
+		if journal_file is not None:
+			journal_file.close()
 	
+	print(progress.report())
+
 if __name__ == '__main__':
 	
-	# First command line argument is the channel number. This is required.
-	channel = int(sys.argv[1])
+	parser = argparse.ArgumentParser(description='Resample old GageScope signal files of a channel to a lower sample rate.')
+	parser.add_argument('channel', type=int, help='Channel number')
+	parser.add_argument('subpath', nargs='?', default=None, help='Subpath to scan under the root, e.g. a year')
+	parser.add_argument('--root', default="/mnt/shotnoise/Data/")
+	parser.add_argument('--backup', default="/mnt/shotnoise/ResampleBackup/", help='Location to move the originals to')
+	parser.add_argument('--rate', type=float, default=2e6, help='Target sample rate')
+	parser.add_argument('--workers', type=int, default=None, help='Worker processes (default: number of CPUs)')
+	parser.add_argument('--io-limit', type=int, default=2, help='Files read or written at the same time')
+	parser.add_argument('--journal', default=None, help='Journal of completed files (default: resample_CHxx.journal)')
+	parser.add_argument('--manifest', default=None, help='Header manifest (.npz) to speed up rescans')
+	args = parser.parse_args()
 	
-	# Hard coded data root and backup root
-	root = "/mnt/shotnoise/Data/"
-	backup = "/mnt/shotnoise/ResampleBackup/"
+	root = args.root
+	backup = args.backup
 	#root = "/mnt/dataraid/Data/"
 	#backup = "/mnt/dataraid/Backup/"
 
-	# If provided, the second argument is a subpath to scan under the root.
-	if len(sys.argv) > 2:
-		year = sys.argv[2]
-
-		root = path.join(root, year)
-		backup = path.join(backup, year)
+	if args.subpath is not None:
+		root = path.join(root, args.subpath)
+		backup = path.join(backup, args.subpath)
+	
+	journal = args.journal
+	if journal is None:
+		journal = 'resample_CH{:02d}.journal'.format(args.channel)
 
-	print("Channel: ", channel)
+	print("Channel: ", args.channel)
 	print("Data Root: ", root)
 	print("Backup Root: ", backup)
-	resample_channel_recursive(root, channel=channel, resample_rate=2e6, backup=backup)
+	print("Journal: ", journal)
+	resample_channel_recursive(root, channel=args.channel, resample_rate=args.rate, backup=backup,
+		manifest=args.manifest, workers=args.workers, io_limit=args.io_limit, journal=journal)
 
 ## code to resample and display a test trace
 #	filename = 'AS_CH02-00001.sig' #sys.argv[1]
 #	target = 'AS_CH02-00001.sig2' #sys.argv[2]
-#	data, filtered, sample_rate, decimation_factor = resample_file(filename, 2e6, target=target)
-#	plot_resample(data, filtered, sample_rate, decimation_factor)
\ No newline at end of file
+#	sample_rate, decimation_factor = resample_file(filename, 2e6, target=target)
+#	plot_resample(sigfile.open_sig(filename).data, sigfile.open_sig(target).data, sample_rate, decimation_factor)
\ No newline at end of file
@@ -0,0 +1,158 @@
+from __future__ import division, print_function
+import argparse
+import fnmatch
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from os import path
+
+import numpy as np
+import h5py
+
+import sigfile
+import sigscan
+
+# Packs legacy TRAD mode runs, laid out as <run>_CHxx/Folder.00001/AS_CHxx-NNNNN.sig with one file per trigger, into
+# one HDF5 file per run and channel: <run>_CHxx.h5 with a (files, samples) int16 dataset 'data', the sig headers of
+# all files in the table 'headers', and the file names, sizes and mtimes in 'files'.
+
+
+def find_runs(root):
+    # Returns the Folder.00001 directories of all <run>_CHxx channel runs below root
+    runs = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        if path.basename(dirpath) == 'Folder.00001' and fnmatch.fnmatch(path.basename(path.dirname(dirpath)), '*_CH??'):
+            runs.append(dirpath)
+            dirnames[:] = []
+    return sorted(runs)
+
+
+def target_file(run_path, root=None, output=None):
+    # <run>_CHxx.h5 next to the <run>_CHxx directory, or at the same relative location below output
+    channel_dir = path.dirname(run_path)
+    filename = path.join(path.dirname(channel_dir), path.basename(channel_dir) + '.h5')
+    if output is not None:
+        filename = path.join(output, path.relpath(filename, root))
+    return filename
+
+
+def convert_run(run_path, filename, compression='gzip', compression_opts=4, shuffle=True, verify=True):
+    # Returns (number of files packed, files that failed verification). The output only gets its final name once
+    # it has been verified; a failed one is kept as <filename>.bad for inspection.
+    headers = sigscan.scan_headers(run_path, pattern='AS_CH??-*.sig', workers=8)
+    headers = headers[headers['valid']]
+    if len(headers) == 0:
+        return 0, []
+
+    lengths = np.minimum(headers['header']['sample_depth'], (headers['size'] - sigfile.SIG_HEADER_SIZE) // 2)
+    samples = max(int(lengths.max()), 1)
+    first = headers['header'][0]
+
+    target_path = path.dirname(filename)
+    if target_path and not path.exists(target_path):
+        os.makedirs(target_path)
+
+    partial_file = filename + '.part'
+    with h5py.File(partial_file, 'w') as hf:
+        hf.attrs['source'] = run_path
+        hf.attrs['sample_rate'] = sigfile.header_sample_rate(first)
+        hf.attrs['dx'] = 1.0 / sigfile.header_sample_rate(first)
+        hf.attrs['input_range'] = sigfile.GAIN_RANGE[first['captured_gain']]
+        hf.attrs['sample_offset'] = first['sample_offset']
+        hf.attrs['sample_res'] = first['sample_resolution']
+
+        files = np.zeros(len(headers), dtype=[('name', 'S64'), ('size', '<i8'), ('mtime', '<f8'), ('length', '<i8')])
+        files['name'] = [path.basename(str(p)).encode() for p in headers['path']]
+        files['size'] = headers['size']
+        files['mtime'] = headers['mtime']
+        files['length'] = lengths
+        hf.create_dataset('files', data=files)
+        hf.create_dataset('headers', data=headers['header'])
+
+        dset = hf.create_dataset('data', shape=(len(headers), samples), dtype=np.int16, chunks=(1, samples),
+                                 compression=compression, compression_opts=compression_opts, shuffle=shuffle)
+
+        for idx, entry in enumerate(headers):
+            with sigfile.open_sig(str(entry['path'])) as sig:
+                dset[idx, :len(sig.data)] = sig.data
+
+    errors = verify_run(run_path, partial_file) if verify else []
+    os.replace(partial_file, filename + '.bad' if errors else filename)
+    return len(headers), errors
+
+
+def verify_run(run_path, filename):
+    # Compares the packed file against the original sig files. Returns a list of mismatching file names.
+    errors = []
+    with h5py.File(filename, 'r') as hf:
+        files = hf['files'][:]
+        headers = hf['headers']
+        dset = hf['data']
+
+        names = set(name.decode() for name in files['name'])
+        for name in os.listdir(run_path):
+            if fnmatch.fnmatch(name, 'AS_CH??-*.sig') and name not in names:
+                errors.append(name)
+
+        for idx, entry in enumerate(files):
+            name = entry['name'].decode()
+            try:
+                with sigfile.open_sig(path.join(run_path, name)) as sig:
+                    length = entry['length']
+                    if (len(sig.data) != length or headers[idx] != sig.header
+                            or not np.array_equal(dset[idx, :length], sig.data)):
+                        errors.append(name)
+            except (IOError, OSError):
+                errors.append(name)
+
+    return errors
+
+
+def _convert_task(run_path, filename, verify, options):
+    start = time.perf_counter()
+    count, errors = convert_run(run_path, filename, verify=verify, **options)
+    return count, errors, time.perf_counter() - start
+
+
+def convert_all(root, output=None, workers=None, verify=True, overwrite=False, **options):
+    runs = find_runs(root)
+    print('Found {:d} runs below {}'.format(len(runs), root))
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        for run_path in runs:
+            filename = target_file(run_path, root, output)
+            if path.exists(filename) and not overwrite:
+                print('Skipping {}, {} exists'.format(run_path, filename))
+                continue
+            futures[executor.submit(_convert_task, run_path, filename, verify, options)] = (run_path, filename)
+
+        for future in as_completed(futures):
+            run_path, filename = futures[future]
+            try:
+                count, errors, elapsed = future.result()
+            except Exception as e:
+                print('Error converting {}: {}'.format(run_path, e))
+                continue
+
+            if len(errors) > 0:
+                print('Verification of {} failed for {:d} files, kept as {}.bad: {}'.format(
+                    filename, len(errors), filename, ', '.join(errors)))
+            else:
+                print('Packed {:d} files into {} in {:.1f} s'.format(count, filename, elapsed))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Pack TRAD mode *.sig runs into one HDF5 file per run and channel.')
+    parser.add_argument('root', help='Directory to search for <run>_CHxx/Folder.00001 runs')
+    parser.add_argument('--output', default=None, help='Output root (default: next to the run directories)')
+    parser.add_argument('--workers', type=int, default=None, help='Runs converted in parallel')
+    parser.add_argument('--compression', default='gzip')
+    parser.add_argument('--level', type=int, default=4, help='gzip compression level')
+    parser.add_argument('--no-verify', action='store_true', help='Skip comparing the output with the originals')
+    parser.add_argument('--overwrite', action='store_true')
+    args = parser.parse_args()
+
+    convert_all(args.root, output=args.output, workers=args.workers, verify=not args.no_verify,
+                overwrite=args.overwrite, compression=args.compression,
+                compression_opts=args.level if args.compression == 'gzip' else None)
@@ -0,0 +1,173 @@
+from __future__ import division, print_function
+import datetime
+import os
+
+import numpy as np
+
+# Reader for GageScope *.sig files: a 512 byte header (csapi.SigFileHeader) followed by the int16 samples.
+# Files are opened as memory maps, so opening a file costs a header read, and samples are only read (and scaled to
+# volts) when they are accessed.
+
+SIG_HEADER_SIZE = 512
+
+# numpy equivalent of csapi.SigFileHeader (_pack_=1, little endian)
+SIG_HEADER_DTYPE = np.dtype([
+    ('file_version', 'S14'),
+    ('crlf1', 'S2'),
+    ('name', 'S9'),
+    ('crlf2', 'S2'),
+    ('comment', 'S256'),
+    ('crlf3', 'S2'),
+    ('control_z', 'S2'),
+    ('sample_rate_index', '<i2'),
+    ('operation_mode', '<i2'),
+    ('trigger_depth', '<i4'),
+    ('trigger_slope', '<i2'),
+    ('trigger_source', '<i2'),
+    ('trigger_level', '<i2'),
+    ('sample_depth', '<i4'),
+    ('captured_gain', '<i2'),
+    ('captured_coupling', '<i2'),
+    ('current_mem_ptr', '<i4'),
+    ('starting_address', '<i4'),
+    ('trigger_address', '<i4'),
+    ('ending_address', '<i4'),
+    ('trigger_time', '<u2'),
+    ('trigger_date', '<u2'),
+    ('trigger_coupling', '<i2'),
+    ('trigger_gain', '<i2'),
+    ('probe', '<i2'),
+    ('inverted_data', '<i2'),
+    ('board_type', '<u2'),
+    ('resolution_12_bits', '<i2'),
+    ('multiple_record', '<i2'),
+    ('trigger_probe', '<i2'),
+    ('sample_offset', '<i2'),
+    ('sample_resolution', '<i2'),
+    ('sample_bits', '<u2'),
+    ('extended_trigger_time', '<u4'),
+    ('imped_a', '<i2'),
+    ('imped_b', '<i2'),
+    ('external_tbs', '<f4'),
+    ('external_clock_rate', '<f4'),
+    ('file_options', '<i4'),
+    ('version', '<u2'),
+    ('eeprom_options', '<u4'),
+    ('trigger_hardware', '<u4'),
+    ('record_depth', '<u4'),
+    ('padding', 'u1', (127,)),
+])
+
+assert SIG_HEADER_DTYPE.itemsize == SIG_HEADER_SIZE
+
+SAMPLE_RATES = (1.0, 2.0, 5.0, 10.0, 20.0, 50.0, 100.0, 200.0, 500.0, 1e3, 2e3, 5e3, 1e4, 2e4, 5e4, 1e5,
+                2e5, 5e5, 1e6, 2e6, 2.5e6, 5e6, 1e7, 1.25e7, 2e7, 2.5e7, 3e7, 4e7, 5e7, 6e7, 6.5e7, 8e7,
+                1e8, 1.2e8, 1.25e8, 1.3e8, 1.5e8, 2e8, 2.5e8, 3e8, 5e8, 1e9, 2e9, 4e9, 5e9, 8e9, 1e10)
+EXT_CLOCK_INDEX = 47
+
+GAIN_RANGE = (20, 10, 4, 2, 1, .4, .2)  # Vpp, indexed by captured_gain
+
+
+def read_header(filepath):
+    # Reads only the header, returned as a numpy record
+    with open(filepath, 'rb') as f:
+        header = np.fromfile(f, dtype=SIG_HEADER_DTYPE, count=1)
+
+    if len(header) < 1:
+        raise IOError('Incomplete sig file header in {}'.format(filepath))
+
+    return header[0]
+
+
+def header_sample_rate(header):
+    if header['sample_rate_index'] < EXT_CLOCK_INDEX:
+        return SAMPLE_RATES[header['sample_rate_index']]
+    else:
+        return float(header['external_clock_rate'])
+
+
+def sample_rate_index(sample_rate):
+    try:
+        return SAMPLE_RATES.index(sample_rate)
+    except ValueError:
+        return EXT_CLOCK_INDEX
+
+
+def header_timestamp(header):
+    pack_date = int(header['trigger_date'])
+    pack_time = int(header['trigger_time'])
+
+    day = pack_date & 0b11111
+    month = (pack_date >> 5) & 0b1111
+    year = (pack_date >> 9) + 1980
+
+    second = (pack_time & 0b11111) * 2
+    minute = (pack_time >> 5) & 0b111111
+    hour = pack_time >> 11
+    return datetime.datetime(year, month, day, hour, minute, second)
+
+
+class SigFile(object):
+    """
+    Memory-mapped *.sig file. header is a record view of the first 512 bytes and data an int16 view of the samples,
+    both backed by the file (writable with mode='r+').
+    """
+
+    def __init__(self, filepath, mode='r'):
+        self.filepath = filepath
+        self.size = os.path.getsize(filepath)
+
+        if self.size < SIG_HEADER_SIZE:
+            raise IOError('Incomplete sig file header in {}'.format(filepath))
+
+        self._header = np.memmap(filepath, dtype=SIG_HEADER_DTYPE, mode=mode, shape=(1,))
+        self.header = self._header[0]
+
+        # Trust the file size over sample_depth for truncated files
+        length = min(int(self.header['sample_depth']), (self.size - SIG_HEADER_SIZE) // 2)
+        if length > 0:
+            self.data = np.memmap(filepath, dtype=np.int16, mode=mode, offset=SIG_HEADER_SIZE, shape=(length,))
+        else:
+            self.data = np.zeros(0, dtype=np.int16)
+
+    def __len__(self):
+        return len(self.data)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        # Drop the memory maps, the file is closed once no views of it remain
+        self._header = None
+        self.header = None
+        self.data = None
+
+    @property
+    def sample_rate(self):
+        return header_sample_rate(self.header)
+
+    @property
+    def timestamp(self):
+        return header_timestamp(self.header)
+
+    @property
+    def input_range(self):
+        # Full scale range in Vpp
+        return GAIN_RANGE[self.header['captured_gain']]
+
+    def time(self, start=0, stop=None):
+        stop = len(self.data) if stop is None else min(stop, len(self.data))
+        return np.arange(start, stop, dtype=np.double) / self.sample_rate
+
+    def volts(self, start=0, stop=None, dtype=np.double):
+        # Scales (only) the requested range of samples to volts
+        scale = self.input_range / 2 / self.header['sample_resolution']
+        raw = self.data[start:stop]
+        return ((self.header['sample_offset'] - raw.astype(dtype)) * scale).astype(dtype, copy=False)
+
+
+def open_sig(filepath, mode='r'):
+    return SigFile(filepath, mode=mode)
@@ -0,0 +1,134 @@
+from __future__ import division, print_function
+import argparse
+import fnmatch
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import sigfile
+
+# Scans a *.sig archive and collects the headers of all files in one numpy structured array. Only the 512 byte
+# headers are read, from a thread pool since the work is I/O bound. The result can be kept as an .npz manifest,
+# so later scans only re-read files whose size or mtime changed.
+
+
+def manifest_dtype(path_length=260):
+    return np.dtype([
+        ('path', 'U{:d}'.format(path_length)),
+        ('size', '<i8'),
+        ('mtime', '<f8'),
+        ('valid', '?'),
+        ('header', sigfile.SIG_HEADER_DTYPE),
+    ])
+
+
+def walk_files(root, pattern='AS_CH??-*.sig', dir_pattern=None):
+    # Yields os.DirEntry objects of matching files below root. dir_pattern is matched against the directory path.
+    stack = [root]
+    while stack:
+        dirpath = stack.pop()
+        try:
+            entries = list(os.scandir(dirpath))
+        except OSError:
+            continue
+
+        match_dir = dir_pattern is None or fnmatch.fnmatch(dirpath, dir_pattern)
+
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                stack.append(entry.path)
+            elif match_dir and fnmatch.fnmatch(entry.name, pattern):
+                yield entry
+
+
+def _read_entry(filepath):
+    try:
+        return sigfile.read_header(filepath)
+    except (IOError, OSError):
+        return None
+
+
+def load_manifest(filename):
+    with np.load(filename) as npz:
+        return npz['headers']
+
+
+def save_manifest(filename, headers):
+    with open(filename, 'wb') as f:  # Keep the file name as given, np.savez would append .npz
+        np.savez(f, headers=headers)
+
+
+def scan_headers(root, pattern='AS_CH??-*.sig', dir_pattern=None, workers=16, manifest=None, previous=None):
+    """
+    Returns a structured array (see manifest_dtype) of the headers of all matching files below root, sorted by path.
+    Entries of previous (or of the manifest file, if it exists) are reused when size and mtime did not change.
+    If manifest is given, the result is saved there.
+    """
+    if previous is None and manifest is not None and os.path.exists(manifest):
+        previous = load_manifest(manifest)
+
+    known = {}
+    if previous is not None:
+        known = {str(row['path']): row for row in previous}
+
+    files = []
+    reuse = []
+    for entry in walk_files(root, pattern, dir_pattern):
+        stat = entry.stat()
+        row = known.get(entry.path)
+        if row is not None and row['size'] == stat.st_size and row['mtime'] == stat.st_mtime:
+            reuse.append(row)
+        else:
+            files.append((entry.path, stat.st_size, stat.st_mtime))
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        headers = list(executor.map(_read_entry, [filepath for filepath, size, mtime in files]))
+
+    path_length = max([len(filepath) for filepath, size, mtime in files] +
+                      [len(str(row['path'])) for row in reuse] + [1])
+    result = np.zeros(len(files) + len(reuse), dtype=manifest_dtype(path_length))
+
+    for idx, (filepath, size, mtime) in enumerate(files):
+        result[idx]['path'] = filepath
+        result[idx]['size'] = size
+        result[idx]['mtime'] = mtime
+        if headers[idx] is not None:
+            result[idx]['valid'] = True
+            result[idx]['header'] = headers[idx]
+
+    for idx, row in enumerate(reuse, start=len(files)):
+        for name in ('path', 'size', 'mtime', 'valid', 'header'):
+            result[idx][name] = row[name]
+
+    result = result[np.argsort(result['path'])]
+
+    if manifest is not None:
+        save_manifest(manifest, result)
+
+    return result
+
+
+def sample_rates(headers):
+    # Vectorized sigfile.header_sample_rate for an array of headers
+    index = headers['sample_rate_index']
+    table = np.asarray(sigfile.SAMPLE_RATES)
+    internal = table[np.clip(index, 0, len(table) - 1)]
+    return np.where(index < sigfile.EXT_CLOCK_INDEX, internal, headers['external_clock_rate'].astype(np.double))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Collect the headers of all *.sig files below a directory.')
+    parser.add_argument('root')
+    parser.add_argument('--pattern', default='AS_CH??-*.sig')
+    parser.add_argument('--manifest', default=None, help='.npz file to store the headers in, reused on rescans')
+    parser.add_argument('--workers', type=int, default=16)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    headers = scan_headers(args.root, pattern=args.pattern, workers=args.workers, manifest=args.manifest)
+    elapsed = time.perf_counter() - start
+
+    print('Scanned {:d} files ({:d} unreadable) in {:.1f} s'.format(len(headers), np.sum(~headers['valid']),
+                                                                      elapsed))